@@ -34,6 +34,83 @@ import random
 from SoccerNet.utils import getListGames
 from SoccerNet.Downloader import SoccerNetDownloader
 from SoccerNet.DataLoader import Frame, FrameCV
+from automatic_models.extra_utils.helpers import generate_video_frames
+
+
+def transform_frame(frame, transform="crop"):
+    """
+    Transform frame into ResNET input, in the same way as SoccerNet frame grabbers do.
+    :param frame: frame in BGR format
+    :param transform: crop (resize to 224 height and keep central part), resize256crop224 (resize to 256 height and
+     keep central 224x224 square), resize (resize to 224x224, aspect ratio is lost) or None (frame is not changed)
+    :return: transformed frame
+    """
+    if transform == "resize256crop224":
+        frame = imutils.resize(frame, height=256)  # keep aspect ratio
+        off_h = int((frame.shape[0] - 224) / 2)
+        off_w = int((frame.shape[1] - 224) / 2)
+        frame = frame[off_h:off_h + 224, off_w:off_w + 224, :]
+    elif transform == "crop":
+        frame = imutils.resize(frame, height=224)  # keep aspect ratio
+        off_side = int((frame.shape[1] - 224) / 2)
+        frame = frame[:, off_side:off_side + 224, :]
+    elif transform == "resize":
+        frame = cv2.resize(frame, (224, 224), interpolation=cv2.INTER_CUBIC)
+    return frame
+
+
+class FrameStream():
+    """
+    Grab frames with FPS directly from source video. Frames closest to multiples of 1 / FPS are decoded
+    (see `generate_video_frames` with timestamp sampling) and transformed on the fly, so no intermediate low quality
+    video has to be encoded and decoded again. Interface is the same as in SoccerNet FrameCV, but frames are decoded
+    lazily: iterate over stream (or over `chunks`) to keep only part of frames in memory, `frames` decodes all of them.
+    """
+    def __init__(self, video_path, FPS=2, transform=None, start=None, duration=None):
+        self.video_path = video_path
+        self.FPS = FPS
+        self.transform = transform
+        self.start = start
+        self.duration = duration
+        self._frames = None
+
+        capture = cv2.VideoCapture(video_path)
+        fps_video = capture.get(cv2.CAP_PROP_FPS)
+        self.time_second = capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps_video if fps_video else 0
+        capture.release()
+
+    def __iter__(self):
+        """Decode and transform frames one by one."""
+        start_time = self.start or 0
+        end_time = start_time + self.duration if self.duration is not None else None
+        frames = generate_video_frames(self.video_path, desired_frequency=self.FPS, start_time=start_time,
+                                       end_time=end_time, sampling='timestamp')
+        for _, frame in tqdm(frames, desc='Grabbing Video Frames', unit='frame', total=self.estimate_length()):
+            yield transform_frame(frame, self.transform)
+
+    def chunks(self, chunk_size):
+        """Yield arrays with at most chunk_size consecutive frames."""
+        chunk = []
+        for frame in self:
+            chunk.append(frame)
+            if len(chunk) == chunk_size:
+                yield np.array(chunk)
+                chunk = []
+        if chunk:
+            yield np.array(chunk)
+
+    @property
+    def frames(self):
+        """All frames in one array."""
+        if self._frames is None:
+            self._frames = np.array(list(self))
+        return self._frames
+
+    def estimate_length(self):
+        """Estimate number of frames in stream, based on video duration in its header."""
+        start_time = self.start or 0
+        end_time = self.time_second if self.duration is None else min(start_time + self.duration, self.time_second)
+        return max(1, math.floor((end_time - start_time) * self.FPS) + 1)
 
 
 class VideoFeatureExtractor():
@@ -44,7 +121,15 @@ class VideoFeatureExtractor():
                  transform="crop",
                  grabber="opencv",
                  FPS=2.0,
-                 split="all"):
+                 split="all",
+                 chunk_size=256):
+        """
+        :param grabber: skvideo/opencv (SoccerNet grabbers, which decode whole video) or stream (`FrameStream`,
+         only frames sampled with FPS are decoded, video does not have to be converted to low quality first)
+        :param chunk_size: with stream grabber, frames are decoded, preprocessed and passed through the model in
+         chunks of this size and features are written to memory-mapped output, so memory usage does not depend on
+         video length
+        """
 
         self.feature = feature
         self.back_end = back_end
@@ -54,6 +139,7 @@ class VideoFeatureExtractor():
         self.grabber = grabber
         self.FPS = FPS
         self.split = split
+        self.chunk_size = chunk_size
 
 
         if "TF2" in self.back_end:
@@ -72,12 +158,27 @@ class VideoFeatureExtractor():
             self.model.trainable = False
 
         
-    def extractFeatures(self, path_video_input, path_features_output, start=None, duration=None, overwrite=False):
+    def extractFeatures(self, path_video_input, path_features_output, start=None, duration=None, overwrite=False,
+                        reducer=None):
+        """
+        :param path_features_output: path to .npy file with features, it might be None (features are only returned)
+        :param reducer: optional `PCAReducer`, with stream grabber every chunk of features is reduced right after
+         extraction (so not reduced features are never stored), with other grabbers all features are reduced
+         after extraction
+        :return: extracted features
+        """
         logging.info(f"extracting features for video {path_video_input}")
 
-        if os.path.exists(path_features_output) and not overwrite:
+        if path_features_output is not None and os.path.exists(path_features_output) and not overwrite:
             logging.info("Features already exists, use overwrite=True to overwrite them. Exiting.")
             return
+        if "TF2" in self.back_end and self.grabber == "stream":
+            videoLoader = FrameStream(
+                path_video_input, FPS=self.FPS, transform=self.transform, start=start, duration=duration)
+            features = self.extractFeaturesInChunks(videoLoader, path_features_output, reducer=reducer)
+            logging.info(f"features {features.shape}, fps={features.shape[0] / max(videoLoader.time_second, 1e-6)}")
+            return features
+
         if "TF2" in self.back_end:
 
             if self.grabber == "skvideo":
@@ -99,12 +200,91 @@ class VideoFeatureExtractor():
 
             logging.info(f"features {features.shape}, fps={features.shape[0]/duration}")
 
+            if reducer is not None:
+                features = reducer.reduceArray(features)
+
         # save the featrue in .npy format
-        os.makedirs(os.path.dirname(path_features_output), exist_ok=True)
-        np.save(path_features_output, features)
+        if path_features_output is not None:
+            os.makedirs(os.path.dirname(path_features_output), exist_ok=True)
+            np.save(path_features_output, features)
+        return features
+
+    def extractFeaturesInChunks(self, videoLoader, path_features_output=None, reducer=None):
+        """
+        Decode, preprocess and pass frames through the model in chunks of self.chunk_size frames. Output array is
+        preallocated for estimated number of frames (and resized at the end, if estimation was wrong), so only one
+        chunk of frames is held in memory. If path_features_output is provided, output is .npy file opened as memory
+        map, otherwise it is kept in memory.
+        :param videoLoader: `FrameStream`
+        :param path_features_output: optional path to .npy file
+        :param reducer: optional `PCAReducer`, which reduces every chunk of features
+        :return: features (memory-mapped from path_features_output, if it is provided)
+        """
+        n_outputs = self.model.output_shape[-1] if reducer is None else reducer.getOutputSize(
+            self.model.output_shape[-1])
+        shape = (videoLoader.estimate_length(), n_outputs)
+        if path_features_output is not None:
+            os.makedirs(os.path.dirname(path_features_output) or ".", exist_ok=True)
+            features = np.lib.format.open_memmap(path_features_output, mode="w+", dtype=np.float32, shape=shape)
+        else:
+            features = np.zeros(shape, dtype=np.float32)
+        n_frames = 0
+        for chunk in videoLoader.chunks(self.chunk_size):
+            if n_frames + len(chunk) > len(features):
+                n_rows = max(2 * len(features), n_frames + len(chunk))
+                features = resize_features(features, path_features_output, n_rows)
+            # preprocessing makes float copy only of current chunk
+            chunk_features = self.model.predict(preprocess_input(chunk), batch_size=64, verbose=0)
+            if reducer is not None:
+                chunk_features = reducer.reduceArray(chunk_features)
+            features[n_frames:n_frames + len(chunk)] = chunk_features
+            n_frames += len(chunk)
+        if n_frames == 0:
+            raise Exception(f"No frames were decoded from {videoLoader.video_path}.")
+        if n_frames != len(features):
+            features = resize_features(features, path_features_output, n_frames)
+        if path_features_output is not None:
+            features.flush()
+        return features
+
+
+def resize_features(features, path, n_rows):
+    """
+    Change number of rows of features array (new rows are zeros), features are either memory-mapped from .npy file
+    with given path (see `resize_npy_memmap`) or held in memory (path is None).
+    """
+    if path is not None:
+        return resize_npy_memmap(features, path, n_rows)
+    resized = np.zeros((n_rows, *features.shape[1:]), dtype=features.dtype)
+    n_copied = min(n_rows, len(features))
+    resized[:n_copied] = features[:n_copied]
+    return resized
+
+
+def resize_npy_memmap(array, path, n_rows, chunk_size=4096):
+    """
+    Change number of rows of .npy file opened as memory map (rows are copied in chunks, new rows are zeros).
+    :param array: memory map opened with np.lib.format.open_memmap
+    :param path: path of .npy file
+    :param n_rows: new number of rows
+    :return: resized memory map
+    """
+    tmp_path = f"{path}.tmp.npy"
+    resized = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=array.dtype, shape=(n_rows, *array.shape[1:]))
+    n_copied = min(n_rows, len(array))
+    for i in range(0, n_copied, chunk_size):
+        resized[i:min(i + chunk_size, n_copied)] = array[i:min(i + chunk_size, n_copied)]
+    resized.flush()
+    del array, resized
+    os.replace(tmp_path, path)
+    return np.lib.format.open_memmap(path, mode="r+")
 
 
 class PCAReducer():
+    """
+    Subtract pre-computed average from features and reduce them with pre-computed PCA. Both steps are folded into
+    one affine projection (`reduceArray`): features @ weights + bias.
+    """
     def __init__(self, pca_file=None, scaler_file=None):
         self.pca_file = pca_file
         self.scaler_file = scaler_file
@@ -123,6 +303,36 @@ class PCAReducer():
             with open(self.scaler_file, "rb") as fobj:
                 self.average = pkl.load(fobj)
 
+        self.weights, self.bias = self.getProjection()
+
+    def getProjection(self):
+        """
+        Fold subtraction of average, subtraction of PCA mean and projection on PCA components (with whitening, if PCA
+        was fitted with it) into weights and bias (computed in float64, stored as float32).
+        :return: (weights with shape (n_features, n_components), bias with shape (n_components, )),
+         weights are None if there is no PCA (then only bias, equal to -average, is applied)
+        """
+        average = self.average if self.average is not None else 0.
+        if self.pca is None:
+            return None, -np.asarray(average, dtype=np.float32)
+        weights = self.pca.components_.T.astype(np.float64)
+        if getattr(self.pca, "whiten", False):
+            weights = weights / np.sqrt(self.pca.explained_variance_)
+        mean = self.pca.mean_ if self.pca.mean_ is not None else 0.
+        bias = -(np.asarray(average, dtype=np.float64) + mean) @ weights
+        return weights.astype(np.float32), np.asarray(bias, dtype=np.float32)
+
+    def getOutputSize(self, n_features):
+        """Get size of reduced features."""
+        return n_features if self.weights is None else self.weights.shape[1]
+
+    def reduceArray(self, features):
+        """Reduce features held in memory (e.g chunk of extracted features) with pre-computed affine projection."""
+        features = np.asarray(features, dtype=np.float32)
+        if self.weights is None:
+            return features + self.bias
+        return features @ self.weights + self.bias
+
     def reduceFeatures(self, input_features, output_features, overwrite=False):
         logging.info(f"reducing features {input_features}")
 
@@ -169,7 +379,7 @@ if __name__ == "__main__":
     parser.add_argument('--video', type=str, default="LQ",
                         help="LQ or HQ? [default:LQ]")
     parser.add_argument('--grabber', type=str, default="opencv",
-                        help="skvideo or opencv? [default:opencv]")
+                        help="skvideo, opencv or stream? [default:opencv]")
     parser.add_argument('--FPS', type=float, default=2.0,
                         help="FPS for the features [default:2.0]")
 
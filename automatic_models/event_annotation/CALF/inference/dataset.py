@@ -3,9 +3,7 @@ from torch.utils.data import Dataset
 import numpy as np
 import random
 # import pandas as pd
-import os
 import time
-import ffmpy
 
 from tqdm import tqdm
 # import utils
@@ -19,13 +17,14 @@ from SoccerNet.Downloader import SoccerNetDownloader
 from extra_utils.constants import PATH_TO_AUTOMATIC_MODELS
 from automatic_models.event_annotation.CALF.inference.Features.VideoFeatureExtractor \
     import VideoFeatureExtractor, PCAReducer
+from automatic_models.event_annotation.feature_cache import FeatureCache
 
 
 print(PATH_TO_AUTOMATIC_MODELS)
 
 class SoccerNetClipsTesting(Dataset):
     def __init__(self, path, features="ResNET_PCA512.npy", 
-                framerate=2, chunk_size=240, receptive_field=80):
+                framerate=2, chunk_size=240, receptive_field=80, cache_dir=None, cache_size_mb=1024):
         self.path = path
         self.chunk_size = chunk_size
         self.receptive_field = receptive_field
@@ -33,39 +32,37 @@ class SoccerNetClipsTesting(Dataset):
         self.num_classes = 17
         self.num_detections =15
 
-        #Changing video format to
-        print(os.getcwd())
-        ff = ffmpy.FFmpeg(
-             inputs={self.path: ""},
-             outputs={f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/videoLQ.mkv":
-                          '-y -r 25 -vf scale=-1:224 -max_muxing_queue_size 9999'})
-        print(ff.cmd)
-        ff.run()
+        pca_file = f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/Features/pca_512_TF2.pkl"
+        scaler_file = f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/Features/average_512_TF2.pkl"
+        extractor_parameters = {"feature": "ResNET", "back_end": "TF2", "transform": "crop", "grabber": "stream",
+                                "FPS": self.framerate}
 
-        print("Initializing feature extractor")
-        myFeatureExtractor = VideoFeatureExtractor(
-            feature="ResNET",
-            back_end="TF2",
-            transform="crop",
-            grabber="opencv",
-            FPS=self.framerate)
-
-        print("Extracting frames")
-        myFeatureExtractor.extractFeatures(
-            path_video_input=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/videoLQ.mkv",
-            path_features_output=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/features.npy",
-            overwrite=True)
+        # features are cached by content of video and extraction parameters, cache hit skips extraction entirely
+        cache = FeatureCache(cache_dir, max_size_mb=cache_size_mb) if cache_dir else None
+        cache_key = cache.get_key(self.path, parameters=extractor_parameters, files=[pca_file, scaler_file]) \
+            if cache else None
+        self.features = cache.load(cache_key) if cache else None
+        if self.features is not None:
+            print("Features loaded from cache")
+            return
 
         print("Initializing PCA reducer")
-        myPCAReducer = PCAReducer(
-            pca_file=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/Features/pca_512_TF2.pkl",
-            scaler_file=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/Features/average_512_TF2.pkl")
+        myPCAReducer = PCAReducer(pca_file=pca_file, scaler_file=scaler_file)
+
+        print("Initializing feature extractor")
+        # frames are sampled with framerate directly from source video and resized/cropped on the fly,
+        # so video is not converted to low quality one before extraction
+        myFeatureExtractor = VideoFeatureExtractor(**extractor_parameters)
 
-        print("Reducing with PCA")
-        myPCAReducer.reduceFeatures(
-            input_features=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/features.npy",
-            output_features=f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/features_PCA.npy",
-            overwrite=True)
+        print("Extracting and reducing features")
+        # every chunk of extracted features is reduced with PCA right away, reduced features are kept in memory
+        # and stored in cache only if it is used
+        self.features = np.array(myFeatureExtractor.extractFeatures(
+            path_video_input=self.path,
+            path_features_output=None,
+            reducer=myPCAReducer))
+        if cache:
+            cache.store(cache_key, self.features)
 
 
 
@@ -75,7 +72,7 @@ class SoccerNetClipsTesting(Dataset):
 
         
         # Load features
-        feat_half1 = np.load(f"{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/features_PCA.npy")
+        feat_half1 = self.features
         print("Shape half 1: ", feat_half1.shape)
         size = feat_half1.shape[0]
 
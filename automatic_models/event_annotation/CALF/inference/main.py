@@ -25,7 +25,10 @@ def main(args):
 
     dataset_Test = SoccerNetClipsTesting(path=args.video_path, features=args.features,
                                          framerate=args.framerate, chunk_size=args.chunk_size*args.framerate,
-                                         receptive_field=args.receptive_field*args.framerate)
+                                         receptive_field=args.receptive_field*args.framerate,
+                                         cache_dir=args.feature_cache_dir if getattr(args, 'cache_features', False)
+                                         else None,
+                                         cache_size_mb=getattr(args, 'feature_cache_size_mb', 1024))
 
     # Create the deep learning model
     if args.device == 'cpu':
@@ -92,6 +95,9 @@ if __name__ == '__main__':
     parser.add_argument('--max_num_worker',   required=False, type=int,   default=4, help='number of worker to load data')
 
     parser.add_argument('--loglevel',   required=False, type=str,   default='INFO', help='logging level')
+    parser.add_argument('--cache_features',   required=False, action='store_true',  help='Cache PCA-reduced video features' )
+    parser.add_argument('--feature_cache_dir',   required=False, type=str,   default=os.path.join("outputs", "features_cache"),     help='Folder with cached features' )
+    parser.add_argument('--feature_cache_size_mb',   required=False, type=float,   default=1024,     help='Maximal size of feature cache (in megabytes)' )
 
     args = parser.parse_args()
 
@@ -2,6 +2,7 @@
 
 import torch
 from dataclasses import dataclass
+from automatic_models.extra_utils.constants import PATH_TO_AUTOMATIC_MODELS
 from automatic_models.event_annotation.CALF.inference.main import main
 from typing import Optional, Dict
 
@@ -40,6 +41,9 @@ class EventAnnotatorConfig:
     device: str = 'cpu'  # gpu/cpu modify
     save_predictions: bool = False  # modify
     convert_to_bsc_soccer: bool = True
+    cache_features: bool = False
+    feature_cache_dir: str = f'{PATH_TO_AUTOMATIC_MODELS}/event_annotation/CALF/inference/outputs/features_cache'
+    feature_cache_size_mb: float = 1024
 
 
 class EventAnnotator:
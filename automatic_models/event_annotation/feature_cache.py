@@ -0,0 +1,127 @@
+"""Script implements on-disk cache of video features used by event annotation."""
+
+import hashlib
+import json
+import os
+import time
+import uuid
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# change it, when extracted features change for the same parameters (e.g. different frame sampling)
+FEATURES_VERSION = 1
+
+
+def get_file_fingerprint(path: str, block_size: int = 1 << 20, n_blocks: int = 16) -> str:
+    """
+    Get fingerprint of file content. Small files are hashed whole, for bigger ones (e.g. whole match videos)
+    only n_blocks blocks evenly spread over the file are hashed (together with file size), so fingerprint
+    does not require reading the whole video.
+    :param path: path to file
+    :param block_size: size of hashed blocks in bytes
+    :param n_blocks: number of hashed blocks
+    :return: hex digest
+    """
+    size = os.path.getsize(path)
+    sha = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        if size <= block_size * n_blocks:
+            sha.update(f.read())
+        else:
+            for offset in np.linspace(0, size - block_size, n_blocks).astype(np.int64):
+                f.seek(int(offset))
+                sha.update(f.read(block_size))
+    return sha.hexdigest()
+
+
+class FeatureCache:
+    """
+    FeatureCache stores features extracted from videos in cache_dir, in files named by key, which is computed
+    from content of video and parameters of extraction (see `get_key`), so renamed or copied video is found in cache
+    and changing extractor or PCA does not return stale features.
+    Features are written to unique temporary file and atomically renamed, so concurrent runs (e.g. started from UI)
+    do not overwrite files of each other. When total size of cache exceeds max_size_mb, least recently used entries
+    are removed (use is tracked with modification time of files, which is updated on every hit).
+
+    Parameters for initialization:
+    :param cache_dir: folder with cached features
+    :param max_size_mb: maximal size of cache in megabytes
+    """
+    def __init__(self,
+                 cache_dir: str,
+                 max_size_mb: float = 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_mb = max_size_mb
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(video_path: str,
+                parameters: Optional[Dict] = None,
+                files: Optional[List[str]] = None) -> str:
+        """
+        Get key of video features.
+        :param video_path: path to video
+        :param parameters: json-serializable parameters of extraction (e.g. framerate, transform)
+        :param files: files which extraction depends on (e.g. PCA pickles), their content is part of the key
+        :return: hex digest
+        """
+        description = {'version': FEATURES_VERSION,
+                       'video': get_file_fingerprint(video_path),
+                       'parameters': parameters or {},
+                       'files': [get_file_fingerprint(path) if path and os.path.exists(path) else None
+                                 for path in files or []]}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        """Get features stored under key (and mark them as recently used) or None if they are not in cache."""
+        path = self._get_path(key)
+        try:
+            features = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # entry was evicted (or not fully written by other process), so features have to be computed again
+            return None
+        return features
+
+    def store(self, key: str, features: np.ndarray) -> None:
+        """Store features under key and evict least recently used entries, if cache is too big."""
+        tmp_path = self.cache_dir / f'{key}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, features)
+        os.replace(tmp_path, self._get_path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None, tmp_max_age: float = 24 * 3600) -> None:
+        """
+        Remove least recently used entries, until size of cache is not bigger than max_size_mb.
+        Temporary files older than tmp_max_age seconds (left by crashed runs) are removed too.
+        :param keep: key, which is not removed (e.g. just stored one)
+        """
+        entries = []
+        for path in self.cache_dir.iterdir():
+            try:
+                stat = path.stat()
+                if path.suffix == '.tmp':
+                    if time.time() - stat.st_mtime > tmp_max_age:
+                        path.unlink()
+                elif path.suffix == '.npy':
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except FileNotFoundError:
+                # file was removed by other process
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_mb * 1024 ** 2:
+                break
+            if path.stem == keep:
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.npy'
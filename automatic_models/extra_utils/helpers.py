@@ -1,25 +1,43 @@
 """General helpers for video processing"""
 import math
+import queue
+import threading
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from typing import Tuple, Optional, List, Dict
+from itertools import islice
+from typing import Tuple, Optional, List, Dict, Iterable, Iterator, Callable
 from pathlib import Path
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle, Polygon
 from matplotlib.collections import PatchCollection
 
 
-def divide_video_into_frames(video_path: str,
-                             output_folder: str,
-                             save_raw_frames: bool = False,
-                             desired_frequency: Optional[int] = None) -> List:
+def generate_video_frames(video_path: str,
+                          output_folder: Optional[str] = None,
+                          save_raw_frames: bool = False,
+                          desired_frequency: Optional[float] = None,
+                          start_time: float = 0,
+                          end_time: Optional[float] = None,
+                          sampling: str = 'stride') -> Iterator[Tuple[int, np.ndarray]]:
     """
-    Divide video file into images with desired frequency rate
+    Lazily divide video file into images with desired frequency rate. Frames are decoded one by one and yielded
+    to the caller, so only frames which caller keeps reference to are held in memory.
+    If start_time is provided, decoder seeks to it (nearest keyframe before it) instead of decoding video from
+    the beginning. If end_time is provided, decoding stops after it.
+    Video is advanced with `grab()` and only kept frames are retrieved (converted to BGR image).
+    Two sampling strategies are possible:
+    stride - every floor(fps / desired_frequency) + 1 frame is kept
+    timestamp - frame closest to each multiple of 1 / desired_frequency (based on CAP_PROP_POS_MSEC) is kept,
+    so sampling does not drift for fractional frame rates (E.g 29.97 fps)
     :param video_path: path to video
     :param desired_frequency: number of frames per second generated by splitter, if N
     :param output_folder: location to save new images
     :param save_raw_frames: save frames in output folder
-    :return: None
+    :param start_time: [seconds] first frame is taken from this point in video
+    :param end_time: [seconds] no frames are taken after this point in video, if None video is read till the end
+    :param sampling: stride/timestamp, strategy for choosing frames
+    :return: generator of (frame_number, frame) tuples, frame_number is counted from start_time
     """
     try:
         capture = cv2.VideoCapture(video_path)
@@ -34,27 +52,166 @@ def divide_video_into_frames(video_path: str,
     if (fps / desired_frequency) < 1:
         raise Exception("""Desired fps is bigger than initial fps. Please change desired_frequency parameter to smaller
                         value""")
+    if sampling not in ('stride', 'timestamp'):
+        raise Exception('Invalid sampling strategy. Please choose from {stride, timestamp}')
+
+    if save_raw_frames:
+        output_path = Path(output_folder)
+        if not output_path.exists():
+            output_path.mkdir(parents=True)
 
-    output_path = Path(output_folder)
-    if not output_path.exists() and save_raw_frames:
-        output_path.mkdir(parents=True)
+    position = round(start_time * fps)
+    end_position = math.floor(end_time * fps) if end_time is not None else None
+    if position > 0 and not capture.set(cv2.CAP_PROP_POS_FRAMES, position):
+        # backend is not able to seek, so frames before start_time are skipped without decoding them fully
+        for _ in range(position):
+            capture.grab()
 
-    frames: Dict[str, np.ndarray] = {}
     frame_number = 0
     iterator = math.floor(fps / desired_frequency)
 
-    success, frame = capture.read()
-    while success:
-        if iterator == math.floor(fps / desired_frequency):
-            if save_raw_frames:
-                cv2.imwrite(f'{output_folder}/frame_{frame_number}.jpg', frame)
-            frames[frame_number] = frame
-            frame_number += 1
-            iterator = 0
-        else:
-            iterator += 1
-        success, frame = capture.read()
-    return frames
+    try:
+        while end_position is None or position <= end_position:
+            if not capture.grab():
+                break
+            if sampling == 'timestamp':
+                # frame is kept if it is the closest one to the next desired timestamp
+                timestamp = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                keep_frame = timestamp + 0.5 / fps >= start_time + frame_number / desired_frequency
+            else:
+                keep_frame = iterator == math.floor(fps / desired_frequency)
+                iterator = 0 if keep_frame else iterator + 1
+            if keep_frame:
+                success, frame = capture.retrieve()
+                if not success:
+                    break
+                if save_raw_frames:
+                    cv2.imwrite(f'{output_folder}/frame_{frame_number}.jpg', frame)
+                yield frame_number, frame
+                frame_number += 1
+            position += 1
+    finally:
+        capture.release()
+
+
+def divide_video_into_frames(video_path: str,
+                             output_folder: str,
+                             save_raw_frames: bool = False,
+                             desired_frequency: Optional[int] = None) -> Dict[int, np.ndarray]:
+    """
+    Divide video file into images with desired frequency rate. All frames are kept in memory, for long videos
+    please use `generate_video_frames`.
+    :param video_path: path to video
+    :param desired_frequency: number of frames per second generated by splitter, if N
+    :param output_folder: location to save new images
+    :param save_raw_frames: save frames in output folder
+    :return: dictionary {frame_number: frame}
+    """
+    return dict(generate_video_frames(video_path=video_path,
+                                      output_folder=output_folder,
+                                      save_raw_frames=save_raw_frames,
+                                      desired_frequency=desired_frequency))
+
+
+def chunk_iterable(iterable: Iterable, chunk_size: int) -> Iterator[List]:
+    """
+    Group elements of iterable into lists of at most chunk_size elements. Next chunk is not consumed from
+    iterable before previous one is returned.
+    """
+    assert chunk_size > 0
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
+
+
+def threaded_iterable(iterable: Iterable, maxsize: int = 1) -> Iterator:
+    """
+    Consume iterable in background thread. Items are passed to the caller through bounded queue, so at most
+    maxsize items are produced ahead of the caller. Exceptions raised in background thread are re-raised
+    in the caller.
+    E.g threaded_iterable(map(preprocess, frames)) preprocesses next frames while caller works on current one.
+    :param iterable: iterable (e.g generator), which is consumed in background thread
+    :param maxsize: maximum number of items waiting in queue
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # put item into queue unless caller stopped consuming items
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as e:
+            put((False, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_item, item = items.get()
+            if not is_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter:
+    """
+    BackgroundWriter executes submitted saving functions (e.g saving images) one by one in background thread,
+    so caller does not wait for I/O. Queue of submitted tasks is bounded, submit blocks if it is full.
+    Should be used as a context manager, on exit all submitted tasks are finished and first exception raised
+    by a task (if any) is re-raised.
+    """
+    def __init__(self, maxsize: int = 8):
+        self.tasks = queue.Queue(maxsize=maxsize)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._work, daemon=True)
+
+    def __enter__(self) -> 'BackgroundWriter':
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error and not exc_type:
+            raise self.error
+
+    def submit(self, func: Callable, *args, **kwargs):
+        """Submit func(*args, **kwargs) to be executed in background thread."""
+        if self.error:
+            raise self.error
+        self.tasks.put((func, args, kwargs))
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            if self.error:
+                continue  # after first failure remaining tasks are skipped
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
 
 
 def mask_defined_color_pixels(image: np.ndarray,
@@ -112,27 +269,56 @@ def convert_numpy_to_bitmask(array: np.ndarray) -> np.ndarray:
         return (array > 0).astype(np.int)
 
 
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """
+    Check which points lie inside polygon (even-odd ray casting rule, vectorised over points and polygon edges).
+    :param points: np.array with shape (N, 2), points in x, y notation
+    :param polygon: np.array with shape (M, 2), vertices of polygon (closing vertex might be repeated)
+    :return: boolean np.array with shape (N, )
+    """
+    x, y = points[:, 0:1], points[:, 1:2]
+    x_1, y_1 = polygon[:, 0], polygon[:, 1]
+    x_2, y_2 = np.roll(x_1, -1), np.roll(y_1, -1)
+    # edges crossed by horizontal ray going right from point
+    crosses = (y_1 > y) != (y_2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x_1 + (y - y_1) * (x_2 - x_1) / (y_2 - y_1)
+    return np.count_nonzero(crosses & (x < x_cross), axis=1) % 2 == 1
+
+
+def _create_image_figure(img_array: np.ndarray, fig_size: tuple = (12, 7)):
+    """
+    Create figure with image (BGR) filling whole canvas. Figure is created without pyplot and rendered with Agg,
+    so it does not touch global pyplot state or GUI backend and can be drawn and saved from background threads
+    (see `BackgroundWriter`).
+    :return: (figure, axes)
+    """
+    rgb = img_array[:, :, ::-1].copy()  # convert image from bgr to rgb
+
+    fig = Figure(figsize=fig_size, frameon=False)
+    FigureCanvasAgg(fig)
+
+    ax = fig.add_axes([0., 0., 1., 1.])
+    ax.set_axis_off()
+    ax.imshow(rgb, aspect='auto')
+    return fig, ax
+
+
 def show_save_image_with_lines(img_array: np.ndarray,
                                lines: dict,
                                save_fig_path: Optional[str],
                                fig_size: tuple = (12, 7),
-                               color: str = 'royalblue'
+                               color: str = 'royalblue',
+                               close_fig: bool = False
                                ):
     """
     Show image with predicted lines on it.
     If save_fig provided image is saved in some location
+    Figure is not registered in pyplot (close_fig is kept for compatibility), it is freed when it is not referenced
     """
-    rgb = img_array[:, :, ::-1].copy()  # convert image from bgr to rgb
-
-    fig = plt.figure(frameon=False)
-    fig.set_size_inches(12, 7)
-
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    ax.imshow(rgb, aspect='auto')
+    fig, ax = _create_image_figure(img_array, fig_size)
     for line_name, coords in lines.items():
-        plt.plot([coords[0][0], coords[1][0]], [coords[0][1], coords[1][1]], linewidth=3, color=color)
+        ax.plot([coords[0][0], coords[1][0]], [coords[0][1], coords[1][1]], linewidth=3, color=color)
     if save_fig_path:
         fig.savefig(save_fig_path)
 
@@ -141,18 +327,11 @@ def show_save_objects_with_bboxes(img_array: np.ndarray,
                                   objects: dict,
                                   save_fig_path: Optional[str],
                                   fig_size: tuple = (12, 7),
-                                  color: str = 'royalblue'
+                                  color: str = 'royalblue',
+                                  close_fig: bool = False
                                   ):
 
-    rgb = img_array[:, :, ::-1].copy()  # convert image from bgr to rgb
-
-    fig = plt.figure(frameon=False)
-    fig.set_size_inches(12, 7)
-
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    ax.imshow(rgb, aspect='auto')
+    fig, ax = _create_image_figure(img_array, fig_size)
     rectangles = [Rectangle(xy=(object_dict['x_top_left'], object_dict['y_bottom_right']),
                             width=(object_dict['x_bottom_right'] - object_dict['x_top_left']),
                             height=(object_dict['y_top_left'] - object_dict['y_bottom_right']))
@@ -166,18 +345,11 @@ def show_save_img_with_polygons(img_array: np.ndarray,
                                 points: list,
                                 save_fig_path: Optional[str],
                                 fig_size: tuple = (12, 7),
-                                color: str = 'royalblue'
+                                color: str = 'royalblue',
+                                close_fig: bool = False
                                 ):
 
-    rgb = img_array[:, :, ::-1].copy()  # convert image from bgr to rgb
-
-    fig = plt.figure(frameon=False)
-    fig.set_size_inches(12, 7)
-
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-    ax.imshow(rgb, aspect='auto')
+    fig, ax = _create_image_figure(img_array, fig_size)
     polygons = [Polygon(xy=points, closed=True)]
     pc = PatchCollection(polygons, facecolor=color, alpha=0.4, edgecolor=color)
     ax.add_collection(pc)
@@ -0,0 +1,89 @@
+"""Script implements frame gate, which decides if expensive models should be run on a frame."""
+
+import cv2
+import numpy as np
+
+from dataclasses import dataclass
+from typing import Tuple, Dict, Optional
+from automatic_models.extra_utils.helpers import mask_defined_color_pixels
+
+
+@dataclass
+class FrameGateConfig:
+    """
+    Dataclass used for storing frame gating configuration.
+    """
+    name: str = 'pitch coverage and shot boundary gating'
+    min_pitch_ratio: float = 0.35
+    pitch_min_range: Tuple = (36, 25, 25)
+    pitch_max_range: Tuple = (70, 255, 255)
+    resize_width: int = 160
+    histogram_bins: int = 16
+    shot_boundary_threshold: float = 0.4
+
+
+class FrameGate:
+    """
+    FrameGate is responsible for cheap classification of video frames, before expensive models are run on them.
+    Broadcast footage contains replays, crowd shots, close-ups and graphics, on which homography is meaningless.
+    Frame is classified as pitch (wide view of a pitch) if ratio of pitch-green pixels (HSV mask, see
+    `mask_defined_color_pixels`) is at least min_pitch_ratio. Additionally shot boundaries are detected, by
+    comparing hue-saturation histograms of consecutive frames (Bhattacharyya distance above shot_boundary_threshold).
+    Both are computed on frame downscaled to resize_width.
+    FrameGate keeps histogram of previous frame, so frames must be passed in time order.
+
+    Parameters for initialization:
+    :param model_config: dictionary with keywords arguments, which changes default values in FrameGateConfig
+    """
+    def __init__(self,
+                 model_config: Optional[Dict] = None):
+        self.config = FrameGateConfig()
+        if model_config:
+            for key, value in model_config.items():
+                setattr(self.config, key, value)
+        self.previous_histogram: Optional[np.ndarray] = None
+
+    def __call__(self, image_array: np.ndarray) -> Dict:
+        """
+        Classify frame.
+        :param image_array: image in BGR format
+        :return: dictionary with keys: pitch (True if models should be run on frame), pitch_ratio,
+        shot_boundary (True if frame starts new shot) and histogram_distance (to previous frame)
+        """
+        small_image = self._resize(image_array)
+        pitch_ratio = self.get_pitch_ratio(small_image)
+        histogram = self.get_histogram(small_image)
+        histogram_distance = 0. if self.previous_histogram is None else \
+            float(cv2.compareHist(self.previous_histogram, histogram, cv2.HISTCMP_BHATTACHARYYA))
+        self.previous_histogram = histogram
+        return {'pitch': pitch_ratio >= self.config.min_pitch_ratio,
+                'pitch_ratio': pitch_ratio,
+                'shot_boundary': histogram_distance > self.config.shot_boundary_threshold,
+                'histogram_distance': histogram_distance}
+
+    def get_pitch_ratio(self, image_array: np.ndarray) -> float:
+        """Get ratio of pitch-green pixels on image."""
+        mask = mask_defined_color_pixels(image_array,
+                                         convert_format='HSV',
+                                         min_range=tuple(self.config.pitch_min_range),
+                                         max_range=tuple(self.config.pitch_max_range))
+        return float(np.count_nonzero(mask)) / mask.size
+
+    def get_histogram(self, image_array: np.ndarray) -> np.ndarray:
+        """Get normalized hue-saturation histogram of image."""
+        hsv = cv2.cvtColor(image_array, cv2.COLOR_BGR2HSV)
+        bins = self.config.histogram_bins
+        histogram = cv2.calcHist([hsv], [0, 1], None, [bins, bins], [0, 180, 0, 256])
+        return cv2.normalize(histogram, histogram, alpha=1, norm_type=cv2.NORM_L1)
+
+    def reset(self):
+        """Forget previous frame, so next frame is not treated as shot boundary."""
+        self.previous_histogram = None
+
+    def _resize(self, image_array: np.ndarray) -> np.ndarray:
+        """Downscale image to resize_width (keeping aspect ratio), smaller images are not changed."""
+        height, width = image_array.shape[:2]
+        if width <= self.config.resize_width:
+            return image_array
+        new_height = max(1, round(height * self.config.resize_width / width))
+        return cv2.resize(image_array, (self.config.resize_width, new_height), interpolation=cv2.INTER_AREA)
@@ -1,18 +1,28 @@
 """This module implements handlers, which are responsible for high-level interaction with models."""
 
+import itertools
 import json
+import math
+import multiprocessing
+import time
 import numpy as np
 import cv2
 import dataclasses
+import torch
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Iterator, Iterable, Tuple, List
 from datetime import datetime
 
-from automatic_models.extra_utils.helpers import divide_video_into_frames, \
-    show_save_image_with_lines, show_save_objects_with_bboxes, show_save_img_with_polygons
-from automatic_models.lines_and_field_detection.lines_and_field_detector import LineDetector
-from automatic_models.object_detection.object_detector import ObjectDetector
+from automatic_models.extra_utils.helpers import generate_video_frames, chunk_iterable, threaded_iterable, \
+    BackgroundWriter, show_save_image_with_lines, show_save_objects_with_bboxes, show_save_img_with_polygons
+from automatic_models.lines_and_field_detection.lines_and_field_detector import LineDetector, RegistrationEngine, \
+    LineDetectorConfig
+from automatic_models.object_detection.object_detector import ObjectDetector, ObjectDetectorConfig, \
+    detections_to_dict
+from automatic_models.object_detection.tracker import ObjectTracker
 from automatic_models.event_annotation.event_annotator import EventAnnotator
+from automatic_models.frame_gating.frame_gate import FrameGate
 
 
 class VideoHandler:
@@ -23,10 +33,27 @@ class VideoHandler:
     :param desired_frequency: desired amount of frames per second
     :param output_path: path to saving folder
     :param starting_point: [seconds] indicates when ObjectDetector and Line/Field Detector will start performing.
-     E.g if starting_point = 15. Both models will start annotating from 15 sec of video
+     E.g if starting_point = 15. Both models will start annotating from 15 sec of video. Video decoder seeks
+     to this point, so frames before it are not decoded.
+    :param end_point: [seconds] indicates when ObjectDetector and Line/Field Detector will stop performing.
+     If None, video is annotated till the end.
+    :param sampling: stride/timestamp, strategy of choosing frames (see `generate_video_frames`). Timestamp sampling
+     does not drift for fractional frame rates.
     :param saving_strategy: overwrite - results in folder will be overwritten by new model, add -> results will be added
     at the end of files in folder
     :param models_config_path: optional path to json file, which might be used to specify model parameters
+    :param save_imgs: if True images with predictions are saved in output folder
+    :param frames_in_flight: number of frames processed at once by `process_video` (roughly three times more frames
+     might be held in memory, since decoding and preprocessing of next frames is done in parallel)
+    :param registration_workers: number of processes, between which frames are sharded for lines & field detection
+     (homography registration). Each worker loads registration models once and gets equal part of torch threads.
+    :param gate_frames: if True, frames which are not wide views of a pitch (replays, crowd shots, close-ups,
+     graphics) are skipped by line & field and object detection (see `FrameGate`). Skipped frames and detected
+     shot boundaries are stored in meta data.
+    :param restrict_objects_to_field: if True, object detection is run only on bounding box of field found by lines
+     & field detection and only players standing on the field are kept (spectators, staff and persons on
+     graphics are dropped, balls found in the cropped region are always kept). Lines & field detection must be
+     performed before (or together with) object detection.
     """
     def __init__(self,
                  video_path: str,
@@ -35,14 +62,24 @@ class VideoHandler:
                  starting_point: float = 0,
                  saving_strategy: str = 'overwrite',
                  models_config_path: Optional[str] = None,
-                 save_imgs: bool = False):
+                 save_imgs: bool = False,
+                 frames_in_flight: int = 1,
+                 end_point: Optional[float] = None,
+                 sampling: str = 'stride',
+                 registration_workers: int = 1,
+                 gate_frames: bool = False,
+                 restrict_objects_to_field: bool = False):
 
         if not Path(video_path).exists():
             raise Exception(f"Video path {video_path} does not exist.")
 
         assert isinstance(desired_frequency, float) or isinstance(desired_frequency, int)
         assert isinstance(starting_point, float) or isinstance(starting_point, int)
+        assert end_point is None or end_point > starting_point
+        assert sampling in ['stride', 'timestamp']
         assert saving_strategy in ['overwrite', 'add']
+        assert isinstance(frames_in_flight, int) and frames_in_flight > 0
+        assert isinstance(registration_workers, int) and registration_workers > 0
 
         self.save_images = save_imgs
         self.model_configs = {}
@@ -65,6 +102,13 @@ class VideoHandler:
 
         self.desired_frequency = desired_frequency
         self.starting_point = starting_point
+        self.end_point = end_point
+        self.sampling = sampling
+        self.frames_in_flight = frames_in_flight
+        self.registration_workers = registration_workers
+        self.gate_frames = gate_frames
+        self.restrict_objects_to_field = restrict_objects_to_field
+        self.object_tracker: Optional[ObjectTracker] = None
         self.frames: Optional[Dict[int, np.ndarray]] = None
         self.image_handlers: Optional[Dict[int, ImageHandler]] = None
         self.results = {'actions': {},
@@ -72,7 +116,8 @@ class VideoHandler:
                         'fields': {},
                         'homographies': {},
                         'objects': {}}
-        self.meta_data = {'frequency': desired_frequency}
+        self.meta_data = {'frequency': desired_frequency, 'starting_point': starting_point, 'end_point': end_point,
+                          'sampling': sampling}
         self.saving_strategy = saving_strategy
 
     def save_results_to_files(self) -> None:
@@ -92,105 +137,384 @@ class VideoHandler:
         for name in ['homographies', 'objects', 'lines', 'fields', 'actions']:
             if self.results[name]:
                 file_path = get_files_naming(general_path, name, self.saving_strategy)
+                results = self.results[name]
+                if name == 'objects':
+                    # objects are kept as structured arrays, they are mapped to dictionaries only when saved
+                    results = {idx: detections_to_dict(detections) for idx, detections in results.items()}
                 with open(file_path, 'w') as f:
-                    json.dump(self.results[name], f)
+                    json.dump(results, f)
             with open(get_files_naming(general_path, 'meta_data', self.saving_strategy), 'w') as f:
                 json.dump(self.meta_data, f)
 
+    def frames_source(self) -> Iterator[Tuple[float, np.ndarray]]:
+        """
+        Lazily decode video between starting_point and end_point. Generator yields (timestamp, frame) tuples,
+        where timestamp is given in seconds.
+        """
+        for frame_number, frame in generate_video_frames(video_path=self.video_path,
+                                                         output_folder=self.output_path + '/raw_frames',
+                                                         desired_frequency=self.desired_frequency,
+                                                         start_time=self.starting_point,
+                                                         end_time=self.end_point,
+                                                         sampling=self.sampling):
+            yield self.starting_point + frame_number * (1 / self.desired_frequency), frame
+
+    def gated_frames_source(self) -> Iterator[Tuple[float, np.ndarray]]:
+        """
+        Lazily decode video (see `frames_source`), if gate_frames is set only frames classified as pitch by
+        FrameGate are yielded. Skipped frames (with their pitch ratio) and shot boundaries are stored in meta data.
+        """
+        if not self.gate_frames:
+            yield from self.frames_source()
+            return
+        frame_gate = FrameGate(model_config=self.model_configs.get('frame_gating'))
+        gating = {'config': dataclasses.asdict(frame_gate.config), 'skipped_frames': {}, 'shot_boundaries': []}
+        self.meta_data['frame_gating'] = gating
+        for idx, frame in self.frames_source():
+            decision = frame_gate(frame)
+            if decision['shot_boundary']:
+                gating['shot_boundaries'].append(idx)
+            if decision['pitch']:
+                yield idx, frame
+            else:
+                gating['skipped_frames'][idx] = decision['pitch_ratio']
+
     def divide_video(self):
         """
-        Divide given video into equally spaced frames.
+        Divide given video into equally spaced frames. All frames are kept in memory, for long videos
+        please use `process_video`, which decodes frames lazily.
         """
         if self.frames:
             print('Video is already divided')
         else:
             self.frames, self.image_handlers = {}, {}
-            self.frames = divide_video_into_frames(video_path=self.video_path,
-                                                   output_folder=self.output_path + '/raw_frames',
-                                                   desired_frequency=self.desired_frequency)
-            for idx, frame in self.frames.items():
-                self.image_handlers[self.starting_point + idx * (1 / self.desired_frequency)] = \
-                    ImageHandler(idx=self.starting_point + idx * (1 / self.desired_frequency), image_array=frame)
+            for idx, frame in self.gated_frames_source():
+                self.frames[idx] = frame
+                self.image_handlers[idx] = ImageHandler(idx=idx, image_array=frame)
+
+    def process_video(self,
+                      perform_lines_fields: bool = False,
+                      perform_objects: bool = False):
+        """
+        Perform lines & field detection and/or object detection (and save images if requested) in one decoding pass.
+        Frames are decoded lazily in chunks of `frames_in_flight` frames (or object detection / registration batch size
+        if it is bigger), so memory usage does not depend on video length. Processing is pipelined:
+        decoding (and frame gating) -> preprocessing (letterbox for object detection) -> inference -> saving images.
+        Decoding, preprocessing and saving images are done in background threads connected with bounded queues,
+        so models do not wait for I/O and Python-side preprocessing.
+        :param perform_lines_fields: If true lines and field detection is performed
+        :param perform_objects: If true object detection is performed
+        """
+        parent_threads = torch.get_num_threads()
+        # objects are detected in this process while workers register frames, so threads are shared with it
+        registration_pool = self._create_registration_pool(share_with_parent=perform_objects) \
+            if perform_lines_fields else None
+        registration_engine = RegistrationEngine(model_config=self.model_configs.get('lines_field_homo_model')) \
+            if perform_lines_fields and not registration_pool else None
+        chunk_size = max(self.frames_in_flight, self._get_objects_batch_size()) if perform_objects \
+            else self.frames_in_flight
+        if perform_lines_fields:
+            chunk_size = max(chunk_size, self._get_registration_batch_size() * self.registration_workers)
+
+        def prepare_chunk(chunk: List[Tuple[float, np.ndarray]]):
+            """Preprocessing stage, create image handlers and letterbox frames for object detection."""
+            image_handlers = [ImageHandler(idx=idx, image_array=frame) for idx, frame in chunk]
+            # in tracking mode frames are letterboxed only when detector is run on them, frames restricted to field
+            # are cropped before letterboxing
+            letterboxed_batches = self._preprocess_objects_batches(image_handlers) \
+                if perform_objects and self._get_objects_config_value('detection_interval') == 1 \
+                and not self.restrict_objects_to_field else None
+            return image_handlers, letterboxed_batches
+
+        frames = threaded_iterable(self.gated_frames_source(), maxsize=chunk_size)
+        prepared_chunks = threaded_iterable(map(prepare_chunk, chunk_iterable(frames, chunk_size)), maxsize=1)
+        try:
+            with BackgroundWriter(maxsize=2 * chunk_size) as writer:
+                for image_handlers, letterboxed_batches in prepared_chunks:
+                    # with registration pool, workers register frames while objects are detected in this process
+                    registered = self._register_images(image_handlers, registration_engine, registration_pool) \
+                        if perform_lines_fields else None
+                    # objects restricted to field need fields of frames, so registration has to finish first
+                    if perform_lines_fields and self.restrict_objects_to_field:
+                        for image_handler, registration_results in zip(image_handlers, registered):
+                            self._store_lines_and_fields(image_handler, *registration_results, writer=writer)
+                    if perform_objects:
+                        self._detect_objects_on_images(image_handlers, letterboxed_batches, writer)
+                    if perform_lines_fields and not self.restrict_objects_to_field:
+                        for image_handler, registration_results in zip(image_handlers, registered):
+                            self._store_lines_and_fields(image_handler, *registration_results, writer=writer)
+        finally:
+            if registration_pool:
+                registration_pool.shutdown()
+                torch.set_num_threads(parent_threads)
 
     def annotate_events(self):
         """
         Perform event annotation using Event Annotator. Results will be held in self.results['events'].
         """
-        if self.image_handlers:
-            event_annotator = EventAnnotator(video_path=self.video_path,
-                                             model_config=self.model_configs.get('event_annotation_model'))
-            self.results['actions'], event_config = event_annotator()
-
-            self.meta_data['event_annotation_model'] = \
-                {
-                    'model_name': event_config.model_name,
-                    'framerate': event_config.framerate,
-                    'confidence_threshold': event_config.confidence_threshold,
-                    'device': event_config.device,
-                    'save_predictions': event_config.save_predictions
-                }
-        else:
-            print('You must divide video and create image handlers before invoking Event Annotator')
+        event_annotator = EventAnnotator(video_path=self.video_path,
+                                         model_config=self.model_configs.get('event_annotation_model'))
+        self.results['actions'], event_config = event_annotator()
+
+        self.meta_data['event_annotation_model'] = \
+            {
+                'model_name': event_config.model_name,
+                'framerate': event_config.framerate,
+                'confidence_threshold': event_config.confidence_threshold,
+                'device': event_config.device,
+                'save_predictions': event_config.save_predictions
+            }
 
     def detect_lines_and_fields(self):
         """
-        Perform lines and field detection.
+        Perform lines and field detection on frames held in image handlers.
+        Registration models are loaded once and shared between all frames. If registration_workers > 1 frames are
+        sharded between processes of a pool, results are stored in frames order.
         """
         if self.image_handlers:
-            for idx, image_handler in self.image_handlers.items():
-                field, lines, homography, config = image_handler.get_lines_field_and_homography(
-                    model_config=self.model_configs.get('lines_field_homo_model'))
-                self.results['fields'][idx] = field
-                self.results['lines'][idx] = lines
-                self.results['homographies'][idx] = homography
-                if self.save_images:
-                    if not (Path(self.output_path) / 'img_lines').exists():
-                        (Path(self.output_path) / 'img_lines').mkdir()
-                    show_save_image_with_lines(img_array=image_handler.image_array,
-                                               lines=lines,
-                                               save_fig_path=str(Path(self.output_path) / 'img_lines' / f'{idx}.png'))
-                    if not (Path(self.output_path) / 'img_fields').exists():
-                        (Path(self.output_path) / 'img_fields').mkdir()
-                    show_save_img_with_polygons(img_array=image_handler.image_array,
-                                                points=field,
-                                                save_fig_path=str(Path(self.output_path) / 'img_fields' / f'{idx}.png'))
-
-                print(f'{idx} was processed.')
-                if not self.meta_data.get('lines_field_homo_model'):
-                    # add object detection config to meta-data only on first image processed
-                    model_dict = dataclasses.asdict(config)
-                    for name in ['template_path', 'out_dir']:
-                        #  we do not need to hold these parameters in output meta data file
-                        del model_dict[name]
-                    self.meta_data['lines_field_homo_model'] = model_dict
+            registration_pool = self._create_registration_pool()
+            registration_engine = RegistrationEngine(model_config=self.model_configs.get('lines_field_homo_model')) \
+                if not registration_pool else None
+            image_handlers = list(self.image_handlers.values())
+            try:
+                registered = self._register_images(image_handlers, registration_engine, registration_pool)
+                for image_handler, registration_results in zip(image_handlers, registered):
+                    self._store_lines_and_fields(image_handler, *registration_results)
+            finally:
+                if registration_pool:
+                    registration_pool.shutdown()
         else:
             print('You must divide video and create image handlers before invoking Lines & Field Detection')
 
     def detect_objects(self):
         """
-        Perform object detection using Object Detector. Results will be held in self.results['objects'].
+        Perform object detection using Object Detector on frames held in image handlers.
+        Results will be held in self.results['objects'].
+        If detection_interval in object detection config is bigger than 1, tracking mode is used: detector is run only
+        on keyframes and objects are propagated between them by tracker (see `ObjectTracker`), objects get track_id.
+        If restrict_objects_to_field is True, fields found by `detect_lines_and_fields` are used.
         """
         if self.image_handlers:
-            for idx, image_handler in self.image_handlers.items():
-                objects, config = image_handler.get_objects(
-                    model_config=self.model_configs.get('object_detection_model'))
-                if self.save_images:
-                    if not (Path(self.output_path) / 'img_objects').exists():
-                        (Path(self.output_path) / 'img_objects').mkdir()
-                    show_save_objects_with_bboxes(img_array=image_handler.image_array,
-                                                  objects=objects,
-                                                  save_fig_path=str(Path(self.output_path) / 'img_objects' /
-                                                                    f'{idx}.png'))
-
-                if not self.meta_data.get('object_detection_model'):
-                    # add object detection config to meta-data only on first image handler
-                    self.meta_data['object_detection_model'] = dataclasses.asdict(config)
-
-                self.results['objects'][idx] = objects
-                print(f'{idx} was processed.')
+            self._detect_objects_on_images(list(self.image_handlers.values()))
         else:
             print('You must divide video and create image handlers before invoking Object Detection')
 
+    def _create_registration_pool(self, share_with_parent: bool = False) -> Optional[ProcessPoolExecutor]:
+        """
+        Create pool of processes for lines & field detection, if more than one registration worker is requested.
+        Torch intra-op threads are divided equally between workers.
+        :param share_with_parent: if True (models are run in this process, while pool is active), threads are divided
+         between workers and this process, which torch threads are reduced (caller restores them after shutdown)
+        """
+        if self.registration_workers == 1:
+            return None
+        threads = max(1, torch.get_num_threads() // (self.registration_workers + int(share_with_parent)))
+        if share_with_parent:
+            torch.set_num_threads(threads)
+        # spawn is used, since forking process with initialized torch thread pool might deadlock
+        return ProcessPoolExecutor(max_workers=self.registration_workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_registration_worker,
+                                   initargs=(self.model_configs.get('lines_field_homo_model'), threads))
+
+    def _register_images(self,
+                         image_handlers: List['ImageHandler'],
+                         registration_engine: Optional[RegistrationEngine] = None,
+                         registration_pool: Optional[ProcessPoolExecutor] = None) -> Iterable[Tuple]:
+        """
+        Perform lines and field detection on frames, either in this process with registration engine, or in pool.
+        Frames are registered in batches of size defined in lines & field detection model config.
+        With pool all frames are submitted at once and results are returned in frames order. Each worker gets
+        contiguous shard of frames, so temporal warm start can be used within a shard.
+        :return: iterable of (field, lines, homography, config, optim_stats) tuples
+        """
+        batches = chunk_iterable(image_handlers, self._get_registration_batch_size())
+        if registration_pool:
+            batches = [[image_handler.image_array for image_handler in batch] for batch in batches]
+            return itertools.chain.from_iterable(
+                registration_pool.map(_register_images_batch, batches,
+                                      chunksize=math.ceil(len(batches) / self.registration_workers)))
+        return itertools.chain.from_iterable(
+            ImageHandler.get_lines_fields_and_homographies_batch(batch, registration_engine=registration_engine)
+            for batch in batches)
+
+    def _store_lines_and_fields(self,
+                                image_handler: 'ImageHandler',
+                                field,
+                                lines,
+                                homography,
+                                config,
+                                optim_stats: Optional[Dict] = None,
+                                writer: Optional[BackgroundWriter] = None):
+        """
+        Store lines, field and homography detected on one frame (and save images if requested).
+        Number of optimization iterations and final loss are stored in meta data.
+        If writer is provided, images are saved in background thread.
+        """
+        idx = image_handler.idx
+        image_handler.field, image_handler.lines, image_handler.homography = field, lines, homography
+        self.results['fields'][idx] = field
+        self.results['lines'][idx] = lines
+        self.results['homographies'][idx] = homography
+        if self.save_images:
+            if not (Path(self.output_path) / 'img_lines').exists():
+                (Path(self.output_path) / 'img_lines').mkdir()
+            self._save(writer, show_save_image_with_lines,
+                       img_array=image_handler.image_array,
+                       lines=lines,
+                       save_fig_path=str(Path(self.output_path) / 'img_lines' / f'{idx}.png'),
+                       close_fig=True)
+            if not (Path(self.output_path) / 'img_fields').exists():
+                (Path(self.output_path) / 'img_fields').mkdir()
+            self._save(writer, show_save_img_with_polygons,
+                       img_array=image_handler.image_array,
+                       points=field,
+                       save_fig_path=str(Path(self.output_path) / 'img_fields' / f'{idx}.png'),
+                       close_fig=True)
+
+        print(f'{idx} was processed.')
+        if not self.meta_data.get('lines_field_homo_model'):
+            # add object detection config to meta-data only on first image processed
+            model_dict = dataclasses.asdict(config)
+            for name in ['template_path', 'out_dir']:
+                #  we do not need to hold these parameters in output meta data file
+                del model_dict[name]
+            self.meta_data['lines_field_homo_model'] = model_dict
+        if optim_stats:
+            stats = self.meta_data.setdefault('lines_field_homo_optimization', {'avg_iterations': 0,
+                                                                               'iterations': {},
+                                                                               'final_loss': {},
+                                                                               'stop_reason': {}})
+            stats['iterations'][idx] = optim_stats['iterations']
+            stats['final_loss'][idx] = optim_stats['final_loss']
+            stats['stop_reason'][idx] = optim_stats['stop_reason']
+            stats['avg_iterations'] += (optim_stats['iterations'] - stats['avg_iterations']) / \
+                len(stats['iterations'])
+
+    def _get_registration_batch_size(self) -> int:
+        """Get number of frames, which are registered at once during lines & field detection."""
+        lines_config = self.model_configs.get('lines_field_homo_model') or {}
+        return lines_config.get('batch_size', LineDetectorConfig.batch_size)
+
+    def _get_objects_batch_size(self) -> int:
+        """Get number of frames, which object detector processes in one forward pass."""
+        return self._get_objects_config_value('batch_size')
+
+    def _get_objects_config_value(self, name: str):
+        """Get value from object detection config (or its default value)."""
+        object_config = self.model_configs.get('object_detection_model') or {}
+        return object_config.get(name, getattr(ObjectDetectorConfig, name))
+
+    def _preprocess_objects_batches(self, image_handlers: List['ImageHandler']) -> List[np.ndarray]:
+        """Letterbox frames for object detection, in batches of size defined in object detection model config."""
+        object_detector = ObjectDetector(model_config=self.model_configs.get('object_detection_model'))
+        return [object_detector.preprocess([image_handler.image_array for image_handler in batch])
+                for batch in chunk_iterable(image_handlers, self._get_objects_batch_size())]
+
+    def _detect_objects_on_images(self,
+                                  image_handlers: List['ImageHandler'],
+                                  letterboxed_batches: Optional[List[np.ndarray]] = None,
+                                  writer: Optional[BackgroundWriter] = None):
+        """
+        Perform object detection on frames (in batches of size defined in object detection model config)
+        and store results (and images if requested).
+        :param letterboxed_batches: batches already preprocessed by `_preprocess_objects_batches`
+        :param writer: if provided, images are saved in background thread
+        """
+        model_config = self.model_configs.get('object_detection_model')
+        if self._get_objects_config_value('detection_interval') > 1:
+            self._track_objects_on_images(image_handlers, writer)
+            return
+        for i, batch in enumerate(chunk_iterable(image_handlers, self._get_objects_batch_size())):
+            letterboxed = letterboxed_batches[i] if letterboxed_batches else None
+            detections_list, config, timings = ImageHandler.get_objects_batch(batch, model_config=model_config,
+                                                                              letterboxed=letterboxed,
+                                                                              fields=self._get_fields(batch))
+            for image_handler, detections in zip(batch, detections_list):
+                self._store_objects(image_handler, detections, config, timings, writer)
+
+    def _track_objects_on_images(self,
+                                 image_handlers: List['ImageHandler'],
+                                 writer: Optional[BackgroundWriter] = None):
+        """
+        Perform object detection on keyframes and propagate objects between them with tracker, which is kept between
+        calls (frames must be given in time order). Keyframes with reason of detection are stored in meta data.
+        """
+        model_config = self.model_configs.get('object_detection_model')
+        config = ObjectDetector(model_config=model_config).config
+        if self.object_tracker is None:
+            get_value = self._get_objects_config_value
+            self.object_tracker = ObjectTracker(detection_interval=get_value('detection_interval'),
+                                                iou_threshold=get_value('track_iou_threshold'),
+                                                max_age=get_value('track_max_age'),
+                                                confidence_decay=get_value('track_confidence_decay'),
+                                                redetect_confidence=get_value('redetect_confidence'),
+                                                shot_change_threshold=get_value('shot_change_threshold'))
+            self.meta_data['object_tracking'] = {'keyframes': {}}
+        for image_handler in image_handlers:
+            start = time.time()
+            reason = self.object_tracker.step(image_handler.image_array)
+            if reason:
+                detections_list, _, timings = ImageHandler.get_objects_batch([image_handler], model_config=model_config,
+                                                                             fields=self._get_fields([image_handler]))
+                tracked = self.object_tracker.update(detections_list[0])
+                self.meta_data['object_tracking']['keyframes'][image_handler.idx] = reason
+            else:
+                tracked = self.object_tracker.get_tracks()
+                timings = {'load_time': self.meta_data['object_detection_times']['load_time'],
+                           'inference_time': time.time() - start}
+            image_handler.objects = tracked
+            self._store_objects(image_handler, tracked, config, timings, writer)
+
+    def _get_fields(self, image_handlers: List['ImageHandler']) -> Optional[List[Optional[List]]]:
+        """Get fields of frames, to which object detection is restricted (None if detection is not restricted)."""
+        if not self.restrict_objects_to_field:
+            return None
+        return [self.results['fields'].get(image_handler.idx) for image_handler in image_handlers]
+
+    def _store_objects(self,
+                       image_handler: 'ImageHandler',
+                       detections: np.ndarray,
+                       config,
+                       timings: Dict,
+                       writer: Optional[BackgroundWriter] = None):
+        """
+        Store objects detected on one frame (and save image if requested).
+        """
+        idx = image_handler.idx
+        if self.save_images:
+            if not (Path(self.output_path) / 'img_objects').exists():
+                (Path(self.output_path) / 'img_objects').mkdir()
+            self._save(writer, show_save_objects_with_bboxes,
+                       img_array=image_handler.image_array,
+                       objects=detections_to_dict(detections),
+                       save_fig_path=str(Path(self.output_path) / 'img_objects' / f'{idx}.png'),
+                       close_fig=True)
+
+        if not self.meta_data.get('object_detection_model'):
+            # add object detection config to meta-data only on first image handler
+            self.meta_data['object_detection_model'] = dataclasses.asdict(config)
+            self.meta_data['object_detection_model']['restricted_to_field'] = self.restrict_objects_to_field
+            # model is loaded once per process, so load time is stored separately from per-frame inference time
+            self.meta_data['object_detection_times'] = {'load_time': timings['load_time'],
+                                                        'avg_inference_time': 0,
+                                                        'inference_times': {}}
+        times = self.meta_data['object_detection_times']
+        times['inference_times'][idx] = timings['inference_time']
+        times['avg_inference_time'] += (timings['inference_time'] - times['avg_inference_time']) / \
+            len(times['inference_times'])
+
+        self.results['objects'][idx] = detections
+        print(f'{idx} was processed.')
+
+    @staticmethod
+    def _save(writer: Optional[BackgroundWriter], save_function, **kwargs):
+        """Call saving function in background writer if it is provided, otherwise call it directly."""
+        if writer:
+            writer.submit(save_function, **kwargs)
+        else:
+            save_function(**kwargs)
+
 
 class ImageHandler:
     """
@@ -210,19 +534,83 @@ class ImageHandler:
         self.objects = None
 
     def get_objects(self, model_config: Optional[Dict] = None):
-        """Get all players and field from one image frame."""
+        """Get all players and ball from one image frame, together with model load and inference times."""
         object_detector = ObjectDetector(idx=self.idx,
                                          image_array=self.image_array,
                                          model_config=model_config)
         object_detector()
         self.objects = object_detector.results
-        return self.objects, object_detector.config
+        return self.objects, object_detector.config, object_detector.timings
+
+    @staticmethod
+    def get_objects_batch(image_handlers: List['ImageHandler'],
+                          model_config: Optional[Dict] = None,
+                          letterboxed: Optional[np.ndarray] = None,
+                          fields: Optional[List[Optional[List]]] = None):
+        """
+        Get all players and ball from many image frames with one forward pass of object detector.
+        Nothing is drawn on image arrays and objects are returned as structured arrays (see `DETECTIONS_DTYPE`).
+        :param letterboxed: image arrays already preprocessed by `ObjectDetector.preprocess`
+        :param fields: optional fields of frames, to which detection is restricted (see `ObjectDetector.detect_batch`)
+        :return: (list with objects for each image handler, config, timings with amortized per-frame inference time)
+        """
+        object_detector = ObjectDetector(model_config=model_config)
+        detections_list = object_detector.detect_batch([image_handler.image_array
+                                                        for image_handler in image_handlers],
+                                                       letterboxed=letterboxed,
+                                                       fields=fields)
+        for image_handler, detections in zip(image_handlers, detections_list):
+            image_handler.objects = detections
+        return detections_list, object_detector.config, object_detector.timings
 
-    def get_lines_field_and_homography(self, model_config: Optional[Dict] = None):
-        """Get field, lines and homography from one image frame."""
+    def get_lines_field_and_homography(self,
+                                       model_config: Optional[Dict] = None,
+                                       registration_engine: Optional[RegistrationEngine] = None):
+        """
+        Get field, lines and homography from one image frame, together with statistics of homography optimization.
+        If registration_engine is provided, its models are reused and model_config is ignored.
+        """
         line_detector = LineDetector(image_array=self.image_array,
-                                     model_config=model_config)
+                                     model_config=model_config,
+                                     registration_engine=registration_engine)
         self.field, self.lines, self.homography, config = line_detector()
-        return self.field, self.lines, self.homography, config
+        return self.field, self.lines, self.homography, config, line_detector.optim_stats
+
+    @staticmethod
+    def get_lines_fields_and_homographies_batch(image_handlers: List['ImageHandler'],
+                                                model_config: Optional[Dict] = None,
+                                                registration_engine: Optional[RegistrationEngine] = None) -> List:
+        """
+        Get field, lines and homography from many image frames (given in time order) registered at once,
+        together with statistics of homography optimization (see `LineDetector.detect_batch`).
+        If registration_engine is provided, its models are reused and model_config is ignored.
+        :return: list of (field, lines, homography, config, optim_stats) tuples for each image handler
+        """
+        line_detectors = LineDetector.detect_batch([image_handler.image_array for image_handler in image_handlers],
+                                                   model_config=model_config,
+                                                   registration_engine=registration_engine)
+        results = []
+        for image_handler, line_detector in zip(image_handlers, line_detectors):
+            image_handler.field, image_handler.lines = line_detector.field, line_detector.lines
+            image_handler.homography = line_detector.homography_inv.tolist()
+            results.append((image_handler.field, image_handler.lines, image_handler.homography, line_detector.config,
+                            line_detector.optim_stats))
+        return results
+
+
+# registration engine of pool worker process, see `VideoHandler._create_registration_pool`
+_WORKER_REGISTRATION_ENGINE: Optional[RegistrationEngine] = None
+
+
+def _init_registration_worker(model_config: Optional[Dict], threads: int):
+    """Initialize pool worker, registration models are loaded only once per worker."""
+    global _WORKER_REGISTRATION_ENGINE
+    torch.set_num_threads(threads)
+    _WORKER_REGISTRATION_ENGINE = RegistrationEngine(model_config=model_config)
 
 
+def _register_images_batch(image_arrays: List[np.ndarray]):
+    """Perform lines and field detection on batch of frames in pool worker."""
+    return ImageHandler.get_lines_fields_and_homographies_batch(
+        [ImageHandler(idx=None, image_array=image_array) for image_array in image_arrays],
+        registration_engine=_WORKER_REGISTRATION_ENGINE)
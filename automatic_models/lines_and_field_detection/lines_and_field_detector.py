@@ -6,11 +6,11 @@ https://github.com/vcg-uvic/sportsfield_release?fbclid=IwAR3_eErOdxlP2QN8KujvDP1
 import json
 import cv2
 from dataclasses import dataclass
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, List
 
 import shapely.errors
 import torch
-from shapely.geometry import LineString, Polygon
+from shapely.geometry import Polygon
 
 from automatic_models.lines_and_field_detection.utils import utils, warp, image_utils, constant_var
 from automatic_models.lines_and_field_detection.models import end_2_end_optimization
@@ -42,6 +42,7 @@ class LineDetectorConfig:
     optim_criterion: str = 'l1loss'
     optim_iters: int = 20
     optim_method: str = 'stn'
+    directh_part: str = 'lower'
     optim_type: str = 'adam'
     prevent_neg: str = 'sigmoid'
     warp_dim: int = 8
@@ -49,6 +50,133 @@ class LineDetectorConfig:
     constant_var_use_cuda: bool = False
     torch_backends_cudnn_enabled: bool = False
     desired_homography: str = 'optim'
+    temporal_warm_start: bool = False
+    scene_change_threshold: float = 0.3
+    early_stopping_tolerance: Optional[float] = None
+    early_stopping_window: int = 10
+    early_stopping_min_improvement: Optional[float] = None
+    optim_loss_target: Optional[float] = None
+    optim_time_budget: Optional[float] = None
+    warp_nan_check: bool = True
+
+
+class RegistrationEngine:
+    """
+    RegistrationEngine holds everything, which is needed for homography calculation and does not depend on a frame:
+    both registration networks (initial guesser and loss surface), preprocessed template image and template lines
+    coordinates. It is meant to be created once (e.g per video) and shared by LineDetectors created for each frame,
+    so checkpoints and template files are read from disk only once.
+    In temporal mode (temporal_warm_start in config) frames are expected in time order. If scene is continuous
+    (mean absolute difference between downscaled consecutive frames is below scene_change_threshold), optimization
+    starts from the state optimized for previous frame (upstream network weights for STN, corners for DirectH)
+    instead of initial guess. Together with early stopping (early_stopping_tolerance, early_stopping_min_improvement,
+    optim_loss_target, optim_time_budget in config) most frames need only few iterations, so optim_iters works as
+    a ceiling. Statistics of last optimization (iterations, final loss, stop reason) are kept in last_optim_stats.
+    With directh optimization method many frames can be registered at once (see `register_batch`).
+
+    Parameters for initialization:
+    :param model_config: dictionary with keywords arguments, which changes default values in LineDetectorConfig
+    """
+    def __init__(self,
+                 model_config: Optional[Dict] = None):
+
+        self.config = LineDetectorConfig()
+        if model_config:
+            for key, value in model_config.items():
+                setattr(self.config, key, value)
+        if self.config.desired_homography not in ['orig', 'optim']:
+            raise Exception('Invalid homography type. Please choose from {orig, optim}')
+        if self.config.desired_homography == 'orig':
+            self.config.optim_iters = 1
+
+        constant_var.USE_CUDA = self.config.constant_var_use_cuda
+        torch.backends_cudnn_enabled = self.config.torch_backends_cudnn_enabled
+
+        self.template_image = cv2.imread(self.config.template_path)
+        with open(self.config.lines_coordinates_path, 'r') as f:
+            self.template_line_coords = json.load(f)
+        self.template_tensor = self.preprocess_template_image(ask_configs=True)
+        self.e2e = end_2_end_optimization.End2EndOptimFactory.get_end_2_end_optimization_model(self.config)
+        self.previous_goal_image: Optional[torch.Tensor] = None
+
+    def register(self, goal_image: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Register preprocessed frame to template.
+        :param goal_image: preprocessed frame (see LineDetector._preprocess_field_image)
+        :return: tuple (orig_homography, optim_homography)
+        """
+        warm_start = self.config.temporal_warm_start and self.is_scene_continuous(goal_image)
+        self.previous_goal_image = goal_image
+        return self.e2e.optim(goal_image[None], self.template_tensor, refresh=not warm_start)
+
+    def register_batch(self, goal_images: List[torch.Tensor]) -> List[Tuple[torch.Tensor, torch.Tensor, Dict]]:
+        """
+        Register many preprocessed frames (given in time order) to template. If optimization method supports it
+        (directh), all frames are registered with one forward/backward pass per iteration and the best iterate is
+        chosen for every frame independently. Otherwise frames are registered one by one.
+        In temporal mode frames of batch start from state optimized for last frame of previous batch, only if whole
+        sequence of frames is continuous.
+        :param goal_images: list with preprocessed frames (see LineDetector._preprocess_field_image)
+        :return: list of tuples (orig_homography, optim_homography, optim_stats) for each frame
+        """
+        if len(goal_images) == 1 or not self.e2e.supports_batch:
+            results = []
+            for goal_image in goal_images:
+                orig_homography, optim_homography = self.register(goal_image)
+                results.append((orig_homography, optim_homography, self.last_optim_stats[0]))
+            return results
+        warm_start = self.config.temporal_warm_start and \
+            all(self.is_scene_continuous(goal_image, previous_goal_image)
+                for goal_image, previous_goal_image in zip(goal_images, [self.previous_goal_image] + goal_images[:-1]))
+        self.previous_goal_image = goal_images[-1]
+        orig_homographies, optim_homographies = self.e2e.optim(torch.stack(goal_images), self.template_tensor,
+                                                               refresh=not warm_start)
+        return list(zip(torch.split(orig_homographies, 1), torch.split(optim_homographies, 1), self.last_optim_stats))
+
+    @property
+    def last_optim_stats(self) -> Optional[List[Dict]]:
+        """
+        Statistics of last optimization for every frame of batch: number of iterations, final loss and reason
+        of stopping.
+        """
+        return self.e2e.last_optim_stats
+
+    def is_scene_continuous(self,
+                            goal_image: torch.Tensor,
+                            previous_goal_image: Optional[torch.Tensor] = None) -> bool:
+        """
+        Check if preprocessed frame shows the same scene as previous frame.
+        :param previous_goal_image: previous frame, if not provided previously registered frame is used
+        """
+        previous_goal_image = self.previous_goal_image if previous_goal_image is None else previous_goal_image
+        if previous_goal_image is None:
+            return False
+        difference = torch.nn.functional.avg_pool2d((goal_image - previous_goal_image)[None], 8).abs().mean()
+        return float(difference) < self.config.scene_change_threshold
+
+    def reset(self):
+        """Forget previously registered frame, so next frame is registered from initial guess."""
+        self.previous_goal_image = None
+
+    def preprocess_template_image(self, ask_configs: bool = False):
+        """
+        Preprocess template image (image containing football field top view), so it is ready to be used by models
+        :param ask_configs: boolean value, if used method performs operations based on LineDetectorConfig
+        :return: transformed image
+        """
+        template_image = cv2.cvtColor(self.template_image, cv2.COLOR_BGR2RGB)
+        template_image = template_image / 255.0
+        if ask_configs:
+            if self.config.coord_conv_template:
+                template_image = image_utils.rgb_template_to_coord_conv_template(template_image)
+            template_image = utils.np_img_to_torch_img(template_image)
+            if self.config.need_single_image_normalization:
+                template_image = image_utils.normalize_single_image(template_image)
+        else:
+            template_image = image_utils.rgb_template_to_coord_conv_template(template_image)
+            template_image = utils.np_img_to_torch_img(template_image)
+
+        return template_image
 
 
 class LineDetector:
@@ -65,30 +193,27 @@ class LineDetector:
     Parameters for initialization:
     :param image_array: (width x height x channels) image in numpy array format. It is assumed that images are loaded
     with opencv package and therefore are in BGR format
-    :param constant_var_use_cuda: boolean value indicating if cuda should be used (set False for CPU, true for GPU)
-    :param torch_backend_cudnn_enabled: boolean value indicating if cuda is enabled (set False for CPU, true for GPU)
-    :parma kwargs: keywords arguments, which changes default values in LineDetectorConfig
+    :param model_config: dictionary with keywords arguments, which changes default values in LineDetectorConfig.
+    Ignored if registration_engine is provided.
+    :param registration_engine: RegistrationEngine shared between frames. If not provided, new one is created.
     """
     def __init__(self,
                  image_array: np.ndarray,
-                 model_config: Optional[Dict] = None):
+                 model_config: Optional[Dict] = None,
+                 registration_engine: Optional[RegistrationEngine] = None):
 
-        self.config = LineDetectorConfig()
+        self.registration_engine = registration_engine if registration_engine \
+            else RegistrationEngine(model_config=model_config)
+        self.config = self.registration_engine.config
         self.image_array = image_array
-        if model_config:
-            for key, value in model_config.items():
-                setattr(self.config, key, value)
-
-        constant_var.USE_CUDA = self.config.constant_var_use_cuda
-        torch.backends_cudnn_enabled = self.config.torch_backends_cudnn_enabled
 
-        self.template_image = cv2.imread(self.config.template_path)
-        with open(self.config.lines_coordinates_path, 'r') as f:
-            self.template_line_coords = json.load(f)
+        self.template_image = self.registration_engine.template_image
+        self.template_line_coords = self.registration_engine.template_line_coords
         self.homography: Optional[np.ndarray] = None
         self.homography_inv: Optional[np.ndarray] = None
         self.lines = {}
         self.field: Optional[np.ndarray] = None
+        self.optim_stats: Optional[Dict] = None
 
     def __call__(self) -> Tuple[np.ndarray, Dict, np.ndarray, Dict]:
         """
@@ -96,11 +221,6 @@ class LineDetector:
         attributes and returns them in particular order.
         :return: tuple (detected_field, detected_lines, homography, config)
         """
-        if self.config.desired_homography not in ['orig', 'optim']:
-            raise Exception('Invalid homography type. Please choose from {orig, optim}')
-        if self.config.desired_homography == 'orig':
-            self.config.optim_iters = 1
-
         self.get_orig_optim_homography(desired=self.config.desired_homography)
 
         # warped_img = self.produce_images_on_homography(self.homography) u
@@ -110,6 +230,35 @@ class LineDetector:
 
         return self.field, self.lines, self.homography_inv.tolist(), self.config
 
+    @classmethod
+    def detect_batch(cls,
+                     image_arrays: List[np.ndarray],
+                     model_config: Optional[Dict] = None,
+                     registration_engine: Optional[RegistrationEngine] = None) -> List['LineDetector']:
+        """
+        Calculate homography, lines and field on many frames (given in time order), all frames are registered
+        at once (see `RegistrationEngine.register_batch`).
+        :param image_arrays: list with images in BGR format
+        :param model_config: dictionary with keywords arguments, which changes default values in LineDetectorConfig.
+        Ignored if registration_engine is provided.
+        :param registration_engine: RegistrationEngine shared between frames. If not provided, new one is created.
+        :return: list with line detectors (one for each frame) with calculated field, lines, homography and
+        optim_stats attributes
+        """
+        registration_engine = registration_engine if registration_engine \
+            else RegistrationEngine(model_config=model_config)
+        line_detectors = [cls(image_array=image_array, registration_engine=registration_engine)
+                          for image_array in image_arrays]
+        registration_results = registration_engine.register_batch([line_detector._preprocess_field_image()
+                                                                   for line_detector in line_detectors])
+        for line_detector, (orig_homography, optim_homography, optim_stats) in zip(line_detectors,
+                                                                                  registration_results):
+            line_detector._set_homography(orig_homography, optim_homography, optim_stats,
+                                          desired=registration_engine.config.desired_homography)
+            line_detector.get_field()
+            line_detector.get_lines()
+        return line_detectors
+
     def get_field(self) -> np.ndarray:
         """
         Find polygons which define pitch shape on a video frame.
@@ -118,9 +267,9 @@ class LineDetector:
         template_shape = (self.template_image.shape[1], self.template_image.shape[0])
         points_template = np.array([[0, 0], [template_shape[0], 0],
                                     [template_shape[0], template_shape[1]], [0, template_shape[1]]])
-        polygon_mapped = Polygon(np.apply_along_axis(
-            lambda k: self._map_template_point_to_frame(k, H_inv=self.homography_inv, out_shape=out_shape,
-                                                        template_shape=template_shape), axis=1, arr=points_template))
+        polygon_mapped = Polygon(self._map_template_points_to_frame(points_template, H_inv=self.homography_inv,
+                                                                    out_shape=out_shape,
+                                                                    template_shape=template_shape))
         polygon_frame = Polygon([[0, 0], [out_shape[0], 0], [out_shape[0], out_shape[1]], [0, out_shape[1]]])
         try:
             coords = np.array(polygon_frame.intersection(polygon_mapped).exterior.coords.xy).transpose()
@@ -134,18 +283,21 @@ class LineDetector:
 
     def get_lines(self):
         """
-        Map template lines to frame.
+        Map template lines to frame. Extremities of all lines are mapped with one homogeneous transform and lines,
+        which leave the frame, are clipped to it.
         """
-        for name, coords in self.template_line_coords.items():
-            new_coords = self._map_line_to_frame(line_point_1=np.array(coords[0]),
-                                                 line_point_2=np.array(coords[1]),
-                                                 h_inv=self.homography_inv,
-                                                 out_shape=(self.image_array.shape[1], self.image_array.shape[0]),
-                                                 template_shape=(self.template_image.shape[1],
-                                                                 self.template_image.shape[0]))
-            if new_coords is not None:
-                self.lines[name] = [[int(new_coords[0, 0]), int(new_coords[0, 1])],
-                                    [int(new_coords[1, 0]), int(new_coords[1, 1])]]
+        names = list(self.template_line_coords.keys())
+        if not names:
+            return
+        out_shape = (self.image_array.shape[1], self.image_array.shape[0])
+        template_shape = (self.template_image.shape[1], self.template_image.shape[0])
+        points_template = np.array([self.template_line_coords[name] for name in names], dtype=float).reshape(-1, 2)
+        lines = self._map_template_points_to_frame(points_template, H_inv=self.homography_inv, out_shape=out_shape,
+                                                   template_shape=template_shape).reshape(-1, 2, 2)
+        new_lines, visible = self._clip_lines_to_frame(lines, out_shape=out_shape)
+        for name, new_coords in zip(np.array(names)[visible], new_lines[visible]):
+            self.lines[name] = [[int(new_coords[0, 0]), int(new_coords[0, 1])],
+                                [int(new_coords[1, 0]), int(new_coords[1, 1])]]
 
     def get_orig_optim_homography(self, desired: str = 'orig'):
         """
@@ -156,9 +308,19 @@ class LineDetector:
         if desired not in ['orig', 'optim']:
             raise Exception('Invalid homography argument. Please choose from {orig, optim}')
         goal_image = self._preprocess_field_image()
-        template_image = self._preprocess_template_image(ask_configs=True)
-        e2e = end_2_end_optimization.End2EndOptimFactory.get_end_2_end_optimization_model(self.config)
-        orig_homography, optim_homography = e2e.optim(goal_image[None], template_image)
+        orig_homography, optim_homography = self.registration_engine.register(goal_image)
+        self._set_homography(orig_homography, optim_homography, self.registration_engine.last_optim_stats[0],
+                             desired=desired)
+
+    def _set_homography(self,
+                        orig_homography: torch.Tensor,
+                        optim_homography: torch.Tensor,
+                        optim_stats: Dict,
+                        desired: str = 'orig'):
+        """
+        Set homography of one of types (and its inverse) and statistics of optimization.
+        """
+        self.optim_stats = optim_stats
         if desired == 'orig':
             self.homography = orig_homography.detach().numpy()
         elif desired == 'optim':
@@ -205,91 +367,79 @@ class LineDetector:
         :param ask_configs: boolean value, if used method performs operations based on LineDetectorConfig
         :return: transformed image
         """
-        template_image = cv2.cvtColor(self.template_image, cv2.COLOR_BGR2RGB)
-        template_image = template_image / 255.0
-        if ask_configs:
-            if self.config.coord_conv_template:
-                template_image = image_utils.rgb_template_to_coord_conv_template(template_image)
-            template_image = utils.np_img_to_torch_img(template_image)
-            if self.config.need_single_image_normalization:
-                template_image = image_utils.normalize_single_image(template_image)
-        else:
-            template_image = image_utils.rgb_template_to_coord_conv_template(template_image)
-            template_image = utils.np_img_to_torch_img(template_image)
+        return self.registration_engine.preprocess_template_image(ask_configs=ask_configs)
 
-        return template_image
+    @staticmethod
+    def _check_points_within_boundaries(points: np.ndarray,
+                                        boundaries: tuple) -> np.ndarray:
+        """
+        Check if points lie inside an image of shape boundaries[0] x boundaries[1]
+        More precisely, check if point[0] is in (0, boundaries[0]], point[1] is in [0, boundaries[1])
+        :param points: np.array with shape (..., 2)
+        :param boundaries; tuple (x_boundary, y_boundary):
+        :returns: boolean np.array with shape (...), True for points inside
+        """
+        return (points[..., 0] > 0) & (points[..., 0] <= boundaries[0]) & \
+            (points[..., 1] >= 0) & (points[..., 1] < boundaries[1])
 
     @staticmethod
-    def _check_point_within_boundaries(point: np.ndarray,
-                                       boundaries: tuple):
-        """
-        Check if point lies inside an image of shape boundaries[0] x boundaries[1]
-        More precisely, check if point[0] is in [0. boundaries[0], point[1] is in [0, boundaries[1]
-        :param point: np.array ([x, y])
-        :param boundaries; tuple (x_buondary, y_buondary):
-        :returns: True if point inside, False otherwise
-        """
-        return (point[0] > 0) and (point[0] <= boundaries[0]) and (point[1] >= 0) and (point[1] < boundaries[1])
-
-    def _map_template_point_to_frame(self,
-                                     frame_point: np.ndarray,
-                                     H_inv: np.ndarray,
-                                     out_shape: tuple,
-                                     template_shape=(1050, 680)) -> np.ndarray:
-        """
-        Map frame point from pitch template to frame.
-        :param frame_point: (x, y) point from template
-        :param H_inv: homography matrix from template to frame (np.array with shape (3,3))
+    def _map_template_points_to_frame(points: np.ndarray,
+                                      H_inv: np.ndarray,
+                                      out_shape: tuple,
+                                      template_shape=(1050, 680)) -> np.ndarray:
+        """
+        Map points from pitch template to frame.
+        :param points: np.array with shape (N, 2), (x, y) points from template
+        :param H_inv: homography matrix from template to frame (np.array with shape (3,3) or (1, 3, 3))
         :param out_shape: video frame shape: (width x height)
         :param template_shape: template shape: (width x height)
-        :returns: np.array([x_new, y_new])
+        :returns: np.array with shape (N, 2), mapped points
         """
-        assert isinstance(frame_point, np.ndarray)
-
-        # moving frame_point to [-0.5, 0.5] range
-        x = frame_point[0] / template_shape[0] - 0.5
-        y = frame_point[1] / template_shape[1] - 0.5
-        xy = np.array([x, y, 1])
-        xy_warped = np.matmul(H_inv, xy)[0]
+        # moving points to [-0.5, 0.5] range
+        x = points[:, 0] / template_shape[0] - 0.5
+        y = points[:, 1] / template_shape[1] - 0.5
+        xy = np.stack([x, y, np.ones_like(x)])
+        xy_warped = np.matmul(np.reshape(H_inv, (3, 3)), xy)
         xy_warped, z_warped = xy_warped[0:2], xy_warped[2]
         xy_warped = 2 * xy_warped / (z_warped + 1e-8)
         x_warped = (xy_warped[0] * 0.5 + 0.5) * out_shape[0]
         y_warped = (xy_warped[1] * 0.5 + 0.5) * out_shape[1]
-        return np.array([x_warped, y_warped])
-
-    def _map_line_to_frame(self,
-                           line_point_1: np.ndarray,
-                           line_point_2: np.ndarray,
-                           h_inv: np.ndarray,
-                           out_shape: tuple,
-                           template_shape=(1050, 680)) -> Optional[np.array]:
-        """
-        Map line from template (more precisely its two extremities) onto frame using homography.
-        :param line_point_1: np.array([x, y]): coordinates of first extremity
-        :param line_point_2: np.array([x, y]): coordinates of second extremity
-        :param h_inv: homography matrix from template to frame
-        :param out_shape: video frame shape: (width x height)
-        :param template_shape: template shape: (width x height)
-        :returns: if both extremities are mapped withing new frame they are returned, Otherwise, function tries to find
-        extremities on a new frame. If no part of line was mapped onto frame, None is returned.
-        """
-        point_1_new = self._map_template_point_to_frame(line_point_1,
-                                                        H_inv=h_inv,
-                                                        out_shape=out_shape,
-                                                        template_shape=template_shape)
-        point_2_new = self._map_template_point_to_frame(line_point_2,
-                                                        H_inv=h_inv,
-                                                        out_shape=out_shape,
-                                                        template_shape=template_shape)
-        flag_1 = self._check_point_within_boundaries(point_1_new, out_shape)
-        flag_2 = self._check_point_within_boundaries(point_2_new, out_shape)
-        if flag_1 and flag_2:
-            # both extremities are mapped inside frame so they define line on frame
-            return np.array([point_1_new, point_2_new])
-        else:
-            # either part of line was mapped onto new frame or nothing
-            line = LineString([point_1_new, point_2_new])
-            polygon = Polygon([(0, 0), (out_shape[0], 0), (out_shape[0], out_shape[1]), (0, out_shape[1])])
-            intersection_points = np.array(polygon.intersection(line).coords.xy).transpose()
-            return intersection_points if intersection_points.size > 0 else None
+        return np.stack([x_warped, y_warped], axis=1)
 
+    @classmethod
+    def _clip_lines_to_frame(cls,
+                             lines: np.ndarray,
+                             out_shape: tuple) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Clip lines (segments) to frame rectangle [0, width] x [0, height] with Liang-Barsky algorithm,
+        all lines are clipped at once.
+        :param lines: np.array with shape (N, 2, 2), two extremities of every line mapped onto frame
+        :param out_shape: video frame shape: (width x height)
+        :returns: tuple (clipped lines with shape (N, 2, 2), boolean np.array with shape (N), True if any part of line
+         was mapped onto frame). Lines with both extremities inside frame are returned without changes.
+        """
+        start, direction = lines[:, 0], lines[:, 1] - lines[:, 0]
+        boundaries = np.array([0, out_shape[0], 0, out_shape[1]], dtype=float)
+        axes = np.array([0, 0, 1, 1])
+        # segment is start + t * direction, t in [0, 1], and it is inside frame if p * t <= q for all 4 boundaries
+        p = np.stack([-direction[:, 0], direction[:, 0], -direction[:, 1], direction[:, 1]], axis=1)
+        q = np.stack([start[:, 0], out_shape[0] - start[:, 0], start[:, 1], out_shape[1] - start[:, 1]], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = q / p
+        t_enter = np.where(p < 0, t, -np.inf)
+        t_exit = np.where(p > 0, t, np.inf)
+        enter_boundary, exit_boundary = t_enter.argmax(axis=1), t_exit.argmin(axis=1)
+        t_0 = np.maximum(t_enter.max(axis=1), 0)
+        t_1 = np.minimum(t_exit.min(axis=1), 1)
+        visible = (t_0 < t_1) & ~((p == 0) & (q < 0)).any(axis=1)
+
+        clipped = np.stack([start + t_0[:, None] * direction, start + t_1[:, None] * direction], axis=1)
+        # clipped extremities are placed exactly on frame boundary
+        rows = np.arange(len(lines))
+        entered, exited = t_0 > 0, t_1 < 1
+        clipped[rows[entered], 0, axes[enter_boundary[entered]]] = boundaries[enter_boundary[entered]]
+        clipped[rows[exited], 1, axes[exit_boundary[exited]]] = boundaries[exit_boundary[exited]]
+
+        inside = cls._check_points_within_boundaries(lines, out_shape).all(axis=1)
+        clipped[inside] = lines[inside]
+        return clipped, visible | inside
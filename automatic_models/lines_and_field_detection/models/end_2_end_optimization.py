@@ -3,6 +3,8 @@ the initial guesser + loss surface optimization
 '''
 
 import abc
+import time
+from typing import Optional
 
 import numpy as np
 import torch
@@ -28,6 +30,7 @@ class End2EndOptim(abc.ABC):
     '''
     model for optimization
     '''
+    supports_batch = False
 
     def __init__(self, opt):
         self.opt = opt
@@ -36,6 +39,7 @@ class End2EndOptim(abc.ABC):
         self.build_models()
         self.build_homography_inference()
         self.lambdas = None
+        self.last_optim_stats = None
 
     def check_options(self):
         valid_models = ['loss_surface']
@@ -50,8 +54,10 @@ class End2EndOptim(abc.ABC):
     def build_criterion(self):
         if self.opt.optim_criterion == 'l1loss':
             self.criterion = torch.nn.L1Loss(reduction='sum')
+            self.sample_criterion = torch.nn.L1Loss(reduction='none')
         elif self.opt.optim_criterion == 'mse':
             self.criterion = torch.nn.MSELoss(reduction='sum')
+            self.sample_criterion = torch.nn.MSELoss(reduction='none')
         else:
             raise ValueError('unknown optimization criterion: {0}'.format(
                 self.opt.optim_criterion))
@@ -84,19 +90,36 @@ class End2EndOptim(abc.ABC):
         return optim
 
     def first_order_main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun):
+        '''
+        optimize loss summed over batch, losses of every frame are tracked separately
+        :return: (loss history with shape (iterations, B), list with corners of every iteration)
+        '''
         loss_hist = []
+        total_loss_hist = []
         corners_optim_list = []
         optimizer = optim_tools['optimizer']
         B = frame.shape[0]
+        start_time = time.time()
+        stop_reason = 'optim_iters'
+        # tensors, which do not change between iterations, are created once
+        target = self.target_dist.repeat(B, 1)
+        sanitize_nan = getattr(self.opt, 'warp_nan_check', True)
         for i in tqdm(range(0, self.opt.optim_iters)):
             corners_optim = get_corners_fun()
-            corners_optim_list.append(corners_optim)
+            # snapshot of iterate, directh returns the same leaf tensor, which is updated in place by optimizer.step
+            corners_optim_list.append(corners_optim.detach().clone())
             inferred_transformation_mat = corner_to_mat_fun(corners_optim)
             warped_tmp = warp.warp_image(
-                template, inferred_transformation_mat, out_shape=frame.shape[-2:])
+                template, inferred_transformation_mat, out_shape=frame.shape[-2:], sanitize_nan=sanitize_nan)
             inferred_dist = self.optim_net((frame, warped_tmp))
-            optim_loss = self.get_loss(inferred_dist, self.target_dist.repeat(B, 1))
-            loss_hist.append(optim_loss.clone().detach().cpu().numpy())
+            sample_losses = self.get_sample_losses(inferred_dist, target)
+            optim_loss = sample_losses.sum()
+            loss_hist.append(sample_losses.clone().detach().cpu().numpy())
+            total_loss_hist.append(loss_hist[-1].sum())
+            converged = self.has_converged(total_loss_hist, start_time)
+            if converged:
+                stop_reason = converged
+                break
             if torch.isnan(optim_loss.data):
                 assert 0, 'loss is nan during optimization'
             else:
@@ -106,12 +129,53 @@ class End2EndOptim(abc.ABC):
             if optim_loss.data < 0.000000:
                 break
         loss_hist = np.array(loss_hist)
+        self.last_optim_stats = [{'iterations': len(loss_hist),
+                                  'final_loss': float(frame_loss_hist.min()),
+                                  'stop_reason': stop_reason} for frame_loss_hist in loss_hist.T]
         return loss_hist, corners_optim_list
 
+    @staticmethod
+    def get_best_corners(loss_hist, corners_optim_list):
+        '''best iterate is chosen for every frame of batch independently'''
+        best_iterations = loss_hist.argmin(axis=0)
+        return torch.stack([corners_optim_list[iteration][b] for b, iteration in enumerate(best_iterations)])
+
+    def has_converged(self, loss_hist, start_time) -> Optional[str]:
+        '''
+        check convergence criteria defined in options (for loss summed over batch), all of them are optional:
+        early_stopping_tolerance - loss changed less than tolerance in last iteration
+        early_stopping_min_improvement - best loss improved relatively less than this value
+        over last early_stopping_window iterations (loss plateau)
+        optim_loss_target - loss reached target value of loss surface
+        optim_time_budget - optimization of frame took more seconds than budget
+        :return: name of satisfied criterion or None
+        '''
+        tolerance = getattr(self.opt, 'early_stopping_tolerance', None)
+        if tolerance and len(loss_hist) > 1 and abs(loss_hist[-2] - loss_hist[-1]) < tolerance:
+            return 'tolerance'
+        min_improvement = getattr(self.opt, 'early_stopping_min_improvement', None)
+        window = getattr(self.opt, 'early_stopping_window', 10)
+        if min_improvement and len(loss_hist) > window:
+            best_before = min(loss_hist[:-window])
+            improvement = (best_before - min(best_before, min(loss_hist[-window:]))) / max(best_before, 1e-12)
+            if improvement < min_improvement:
+                return 'plateau'
+        loss_target = getattr(self.opt, 'optim_loss_target', None)
+        if loss_target is not None and loss_hist[-1] <= loss_target:
+            return 'target'
+        time_budget = getattr(self.opt, 'optim_time_budget', None)
+        if time_budget and time.time() - start_time > time_budget:
+            return 'time_budget'
+        return None
+
     def get_loss(self, output, target):
         optim_loss = self.criterion(output, target)
         return optim_loss
 
+    def get_sample_losses(self, output, target):
+        '''loss of every frame of batch, their sum is equal to get_loss'''
+        return self.sample_criterion(output, target).flatten(1).sum(1)
+
     def main_optimization_loop(self, frame, template, optim_tools, get_corners_fun, corner_to_mat_fun):
         if self.opt.optim_type == 'adam' or 'sgd':
             loss_hist, corners_optim_list = self.first_order_main_optimization_loop(
@@ -127,7 +191,18 @@ class End2EndOptim(abc.ABC):
 
 
 class End2EndOptimDirectH(End2EndOptim):
+    # corners of every frame are separate parameters, so many frames can be registered in one forward/backward pass
+    supports_batch = True
+
+    def __init__(self, opt):
+        super(End2EndOptimDirectH, self).__init__(opt)
+        self.last_optim_corners = None
+
     def optim(self, frame, template, refresh=True):
+        '''
+        if refresh is False, optimization starts from corners optimized for previous frame (warm start),
+        for batch of frames all of them start from corners optimized for last frame of previous batch
+        '''
         def get_corners_directh():
             return corners_optim
 
@@ -145,8 +220,11 @@ class End2EndOptimDirectH(End2EndOptim):
         # canon4pts would be full or lower based on the options
         canon4pts = end_2_end_optimization_helper.get_default_canon4pts(B, canon4pts_type=self.opt.directh_part)
 
-        corners_optim = warp.get_four_corners(upstream_homography, canon4pts=canon4pts[0])
-        corners_optim = corners_optim.permute(0, 2, 1)
+        if refresh or self.last_optim_corners is None:
+            corners_optim = warp.get_four_corners(upstream_homography, canon4pts=canon4pts[0])
+            corners_optim = corners_optim.permute(0, 2, 1)
+        else:
+            corners_optim = self.last_optim_corners[-1:].repeat(B, 1, 1)
         corners_optim = corners_optim.clone().detach().requires_grad_(True)
         optim = self.create_gd_optimizer(params=corners_optim)
         optim_tools = {'optimizer': optim}
@@ -157,12 +235,32 @@ class End2EndOptimDirectH(End2EndOptim):
                                                                     corner_to_mat_directh)
 
         orig_homography = upstream_homography
-        optim_homography = corner_to_mat_directh(corners_optim_list[loss_hist.argmin()])
+        self.last_optim_corners = self.get_best_corners(loss_hist, corners_optim_list).detach()
+        optim_homography = corner_to_mat_directh(self.last_optim_corners)
         return orig_homography, optim_homography
 
 
 class End2EndOptimSTN(End2EndOptim):
+    # upstream network weights are optimized, so they are shared by all frames of batch
+    supports_batch = False
+
+    def __init__(self, opt):
+        super(End2EndOptimSTN, self).__init__(opt)
+        self.upstream_optimizer = None
+
+    def get_upstream_optimizer(self):
+        '''optimizer over upstream weights is created once,
+        for every next frame only its state (e.g adam moments) is reset
+        '''
+        if self.upstream_optimizer is None:
+            self.upstream_optimizer = self.create_gd_optimizer(params=self.homography_inference.get_upstream_params())
+        else:
+            self.upstream_optimizer.state.clear()
+        self.upstream_optimizer.zero_grad()
+        return self.upstream_optimizer
+
     def optim(self, frame, template, refresh=True):
+        '''if refresh is False, upstream weights optimized for previous frame are kept (warm start)'''
         def get_corners_stn():
             return self.homography_inference.infer_upstream_corners(frame)
 
@@ -177,7 +275,7 @@ class End2EndOptimSTN(End2EndOptim):
         assert B == 1, 'STN optimization only support one image at a time'
 
         upstream_homography = self.homography_inference.infer_upstream_homography(frame)
-        optim = self.create_gd_optimizer(params=self.homography_inference.get_upstream_params())
+        optim = self.get_upstream_optimizer()
         optim_tools = {'optimizer': optim}
         loss_hist, corners_optim_list = self.main_optimization_loop(frame,
                                                                     template,
@@ -185,5 +283,6 @@ class End2EndOptimSTN(End2EndOptim):
                                                                     get_corners_stn,
                                                                     corner_to_mat_stn)
         orig_homography = upstream_homography
-        optim_homography = end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(corners_optim_list[loss_hist.argmin()], 'lower')
+        optim_homography = end_2_end_optimization_helper.get_homography_between_corners_and_default_canon4pts(
+            self.get_best_corners(loss_hist, corners_optim_list), 'lower')
         return orig_homography, optim_homography
@@ -1,6 +1,7 @@
 import abc
 
 import numpy as np
+import torch
 
 from lines_and_field_detection.utils import utils
 from lines_and_field_detection.models import init_guesser
@@ -68,9 +69,20 @@ class HomographyInference(abc.ABC):
             self.opt)
         self.upstream = utils.set_model_device(self.upstream)
         self.upstream.eval()
+        self.snapshot_upstream_weights()
+
+    def snapshot_upstream_weights(self):
+        '''keep pristine copy of upstream weights in memory,
+        so refreshing them does not require reading checkpoint from disk
+        '''
+        self.pristine_state_dict = {name: tensor.detach().clone()
+                                    for name, tensor in self.upstream.state_dict().items()}
 
     def refresh(self):
-        self.upstream.load_pretrained_weights()
+        '''restore upstream weights optimized for previous frame with in-place copy of the snapshot'''
+        with torch.no_grad():
+            for name, tensor in self.upstream.state_dict().items():
+                tensor.copy_(self.pristine_state_dict[name])
 
     def get_upstream_params(self):
         assert self.opt.guess_model == 'init_guess'
@@ -5,7 +5,31 @@ import numpy as np
 from lines_and_field_detection.utils import utils
 
 
-def warp_image(img, H, out_shape=None, input_grid=None):
+# homogeneous coordinates of sampling grids, keyed by (height, width, device, dtype), see `get_base_grid`
+_BASE_GRID_CACHE = {}
+
+
+def get_base_grid(out_shape, device, dtype=torch.float32):
+    '''
+    homogeneous coordinates of regular grid in frame coordinates, shape: (3, N)
+    grid is created once for every shape, device and dtype and then reused, so it must not be modified in-place
+    '''
+    key = (int(out_shape[-2]), int(out_shape[-1]), torch.device(device), dtype)
+    if key not in _BASE_GRID_CACHE:
+        y, x = torch.meshgrid([
+            torch.linspace(-utils.BASE_RANGE, utils.BASE_RANGE, steps=key[0]),
+            torch.linspace(-utils.BASE_RANGE, utils.BASE_RANGE, steps=key[1])
+        ], indexing='ij')
+        x, y = x.flatten(), y.flatten()
+        _BASE_GRID_CACHE[key] = torch.stack([x, y, torch.ones_like(x)]).to(device=device, dtype=dtype)
+    return _BASE_GRID_CACHE[key]
+
+
+def warp_image(img, H, out_shape=None, input_grid=None, sanitize_nan=True):
+    '''
+    warp image with homography, nan values in warped image are set to zeros if sanitize_nan is True
+    (check synchronizes and scans whole warped image, so it might be skipped, when nans are detected later anyway)
+    '''
     if out_shape is None:
         out_shape = img.shape[-2:]
     if len(img.shape) < 4:
@@ -14,43 +38,29 @@ def warp_image(img, H, out_shape=None, input_grid=None):
         H = H[None]
     assert img.shape[0] == H.shape[0], 'batch size of images do not match the batch size of homographies'
     batchsize = img.shape[0]
-    # create grid for interpolation (in frame coordinates)
+    # grid for interpolation (in frame coordinates) with appended ones for homogeneous coordinates, shape: (3, N)
     if input_grid is None:
-        y, x = torch.meshgrid([
-            torch.linspace(-utils.BASE_RANGE, utils.BASE_RANGE,
-                           steps=out_shape[-2]),
-            torch.linspace(-utils.BASE_RANGE, utils.BASE_RANGE,
-                           steps=out_shape[-1])
-        ])
-        x = x.to(img.device)
-        y = y.to(img.device)
+        xy = get_base_grid(out_shape, img.device, H.dtype)
     else:
         x, y = input_grid
-    x, y = x.flatten(), y.flatten()
+        x, y = x.flatten(), y.flatten()
+        xy = torch.stack([x, y, torch.ones_like(x)])
 
-    # append ones for homogeneous coordinates
-    xy = torch.stack([x, y, torch.ones_like(x)])
-    xy = xy.repeat([batchsize, 1, 1])  # shape: (B, 3, N)
-    # warp points to model coordinates
-    xy_warped = torch.matmul(H, xy)  # H.bmm(xy)
+    # warp points to model coordinates, grid is broadcasted over batch
+    xy_warped = torch.matmul(H, xy)  # shape: (B, 3, N)
     xy_warped, z_warped = xy_warped.split(2, dim=1)
 
     # we multiply by 2, since our homographies map to
     # coordinates in the range [-0.5, 0.5] (the ones in our GT datasets)
     xy_warped = 2.0 * xy_warped / (z_warped + 1e-8)
-    x_warped, y_warped = torch.unbind(xy_warped, dim=1)
-    # build grid
-    grid = torch.stack([
-        x_warped.view(batchsize, *out_shape[-2:]),
-        y_warped.view(batchsize, *out_shape[-2:])
-    ],
-        dim=-1)
+    # build grid, shape: (B, H, W, 2)
+    grid = xy_warped.transpose(1, 2).reshape(batchsize, *out_shape[-2:], 2)
 
     # sample warped image
     warped_img = torch.nn.functional.grid_sample(
         img, grid, mode='bilinear', padding_mode='zeros')
 
-    if utils.hasnan(warped_img):
+    if sanitize_nan and utils.hasnan(warped_img):
         print('nan value in warped image! set to zeros')
         warped_img[utils.isnan(warped_img)] = 0
 
@@ -12,6 +12,7 @@ for path in (bs_soccer, yolo_path):
 
 from automatic_models.handlers import VideoHandler
 from argparse import ArgumentParser
+from typing import Optional
 
 import time
 
@@ -28,6 +29,9 @@ def parse_args():
     argument_parser.add_argument('-start', '--starting_point', default=0, type=float,
                                  help='Models will start dividing video and provide '
                                       'annotations from this point in video. PLease provide this number in seconds.')
+    argument_parser.add_argument('-end', '--end_point', default=None, type=float,
+                                 help='Models will stop providing annotations after this point in video. '
+                                      'PLease provide this number in seconds. By default video is processed till end.')
     argument_parser.add_argument('-save', '--saving_strategy', default='overwrite', type=str,
                                  help='Choose from add/overwrite. If latter new predictions overwrite older ones.')
     argument_parser.add_argument('-conf', '--models_config_path', default=None, type=str,
@@ -40,6 +44,18 @@ def parse_args():
                                  help='If flag is set model will perform field segmentation and lines detection')
     argument_parser.add_argument('-img', '--save_images',  action='store_true',
                                  help='If flag is set images with predictions will be saved in output folder')
+    argument_parser.add_argument('-smp', '--sampling', default='stride', type=str,
+                                 help='Choose from stride/timestamp. Strategy of choosing frames from video, '
+                                      'timestamp sampling does not drift for fractional frame rates.')
+    argument_parser.add_argument('-fif', '--frames_in_flight', default=1, type=int,
+                                 help='Maximum number of decoded video frames held in memory at once.')
+    argument_parser.add_argument('-rw', '--registration_workers', default=1, type=int,
+                                 help='Number of processes used for lines and field detection.')
+    argument_parser.add_argument('-gf', '--gate_frames', action='store_true',
+                                 help='If flag is set models are run only on frames showing wide view of a pitch.')
+    argument_parser.add_argument('-rf', '--restrict_to_field', action='store_true',
+                                 help='If flag is set objects are detected only on a field found by lines and field '
+                                      'detection (requires -p_lf).')
     return argument_parser.parse_args()
 
 
@@ -52,7 +68,13 @@ def perform_models(video_path: str,
                    perform_events: bool = False,
                    perform_objects: bool = False,
                    perform_lines_fields: bool = False,
-                   save_imgs: bool = False
+                   save_imgs: bool = False,
+                   frames_in_flight: int = 1,
+                   end_point: Optional[float] = None,
+                   sampling: str = 'stride',
+                   registration_workers: int = 1,
+                   gate_frames: bool = False,
+                   restrict_to_field: bool = False
                    ) -> None:
     """
     Perform automatic processing on video.
@@ -68,6 +90,16 @@ def perform_models(video_path: str,
     :param perform_objects: If true model performs object detection
     :param perform_lines_fields: If true model performs lines and field detection
     :param save_imgs: if true images of predictions are saved
+    :param frames_in_flight: maximum number of decoded video frames held in memory at once
+    :param end_point: Models will stop providing annotations after this point in video (in seconds).
+     If None, video is processed till the end.
+    :param sampling: stride/timestamp. Strategy of choosing frames from video, `timestamp` takes frames closest to
+     multiples of 1 / frequency, so it does not drift for fractional frame rates (E.g 29.97 fps)
+    :param registration_workers: number of processes, between which frames are sharded for lines and field detection
+    :param gate_frames: if true, lines & field and object detection are performed only on frames showing wide view
+     of a pitch (replays, crowd shots, close-ups and graphics are skipped and recorded in meta data)
+    :param restrict_to_field: if true, objects are detected only on bounding box of field found by lines and field
+     detection, persons not standing on the field are dropped (requires perform_lines_fields)
     """
     video_handler = VideoHandler(video_path=video_path,
                                  output_path=output_path,
@@ -75,8 +107,13 @@ def perform_models(video_path: str,
                                  starting_point=starting_point,
                                  saving_strategy=saving_strategy,
                                  models_config_path=models_config_path,
-                                 save_imgs=save_imgs)
-    video_handler.divide_video()
+                                 save_imgs=save_imgs,
+                                 frames_in_flight=frames_in_flight,
+                                 end_point=end_point,
+                                 sampling=sampling,
+                                 registration_workers=registration_workers,
+                                 gate_frames=gate_frames,
+                                 restrict_objects_to_field=restrict_to_field and perform_lines_fields)
 
     if perform_events:
         try:
@@ -84,12 +121,14 @@ def perform_models(video_path: str,
             print('Events successfully annotated.')
         except IndexError:
             print('Unable to perform Event Annotator, because file is too short, make sure it is longer than 2 minutes')
-    if perform_lines_fields:
-        video_handler.detect_lines_and_fields()
-        print('Lines and fields successfully detected.')
-    if perform_objects:
-        video_handler.detect_objects()
-        print('Players successfully detected.')
+    if perform_lines_fields or perform_objects:
+        # frames are decoded once and passed through all requested models
+        video_handler.process_video(perform_lines_fields=perform_lines_fields,
+                                    perform_objects=perform_objects)
+        if perform_lines_fields:
+            print('Lines and fields successfully detected.')
+        if perform_objects:
+            print('Players successfully detected.')
 
     video_handler.save_results_to_files()
     print('Files saved.')
@@ -108,7 +147,13 @@ if __name__ == '__main__':
                        perform_events=args.perform_events,
                        perform_objects=args.perform_objects,
                        perform_lines_fields=args.perform_lines_fields,
-                       save_imgs=args.save_images)
+                       save_imgs=args.save_images,
+                       frames_in_flight=args.frames_in_flight,
+                       end_point=args.end_point,
+                       sampling=args.sampling,
+                       registration_workers=args.registration_workers,
+                       gate_frames=args.gate_frames,
+                       restrict_to_field=args.restrict_to_field)
     else:
         perform_models(video_path='data/not_on_repo/videos/test.mp4',
                        output_path='./data/test_22_01',
@@ -0,0 +1,82 @@
+"""Script compares speed and results of object detection backends (pytorch, onnxruntime) on the same frames."""
+
+import argparse
+import json
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from automatic_models.extra_utils.helpers import generate_video_frames
+from automatic_models.object_detection.object_detector import ObjectDetector
+
+
+def run_backend(frames: List[np.ndarray], model_config: Dict, batch_size: int = 1):
+    """
+    Run object detector on frames.
+    :return: (list with detections for each frame, load time, list with per-frame inference times)
+    """
+    detections, inference_times, load_time = [], [], None
+    for i in range(0, len(frames), batch_size):
+        batch = frames[i: i + batch_size]
+        object_detector = ObjectDetector(model_config=model_config)
+        start = time.time()
+        detections += object_detector.detect_batch(batch)
+        inference_times += [(time.time() - start) / len(batch)] * len(batch)
+        if load_time is None:
+            load_time = object_detector.timings['load_time']
+    return detections, load_time, inference_times
+
+
+def compare_detections(reference: List[np.ndarray], detections: List[np.ndarray]) -> Dict:
+    """Compare detections with reference detections (frames with the same number of objects are compared)."""
+    same_count = [len(ref) == len(det) for ref, det in zip(reference, detections)]
+    max_box_diff = max([np.abs(np.stack([ref[field] for field in ref.dtype.names[1:5]]) -
+                               np.stack([det[field] for field in det.dtype.names[1:5]])).max(initial=0)
+                        for ref, det, same in zip(reference, detections, same_count) if same] or [0])
+    return {'% frames with same number of objects': sum(same_count) / len(same_count),
+            'max box difference [px]': float(max_box_diff)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--video_path', type=str, required=True, help='video, on which backends are compared')
+    parser.add_argument('-f', '--frequency', type=float, default=1, help='number of frames per second')
+    parser.add_argument('-n', '--n_frames', type=int, default=50, help='number of frames')
+    parser.add_argument('-mcp', '--models_config_path', type=str, default=None,
+                        help='json with models configuration, object_detection_model config is used')
+    parser.add_argument('-bs', '--batch_size', type=int, default=1)
+    parser.add_argument('-t', '--onnx_threads', type=int, nargs='*', default=[None],
+                        help='numbers of onnxruntime intra-op threads to compare')
+    parser.add_argument('-o', '--output_path', type=str, default='backends_benchmark.csv')
+    args = parser.parse_args()
+
+    base_config = {}
+    if args.models_config_path:
+        with open(args.models_config_path, 'r') as f:
+            base_config = json.load(f).get('object_detection_model', {})
+
+    frames = []
+    for _, frame in generate_video_frames(args.video_path, desired_frequency=args.frequency):
+        frames.append(frame)
+        if len(frames) == args.n_frames:
+            break
+
+    configs = {'pytorch': {**base_config, 'backend': 'pytorch'}}
+    for threads in args.onnx_threads:
+        configs[f'onnxruntime (threads: {threads or "default"})'] = {**base_config, 'backend': 'onnxruntime',
+                                                                      'onnx_threads': threads}
+    results = []
+    reference: Optional[List[np.ndarray]] = None
+    for name, config in configs.items():
+        detections, load_time, inference_times = run_backend(frames, config, batch_size=args.batch_size)
+        reference = detections if reference is None else reference
+        results.append({'backend': name,
+                        'load_time [s]': load_time,
+                        'avg_inference_time [s]': np.mean(inference_times),
+                        'p95_inference_time [s]': np.percentile(inference_times, 95),
+                        **compare_detections(reference, detections)})
+        print(results[-1])
+
+    pd.DataFrame(results).to_csv(args.output_path, index=False)
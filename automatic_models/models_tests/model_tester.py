@@ -10,6 +10,7 @@ from typing import Optional, Dict
 import pandas as pd
 
 from automatic_models.handlers import VideoHandler, ImageHandler
+from automatic_models.object_detection.object_detector import detections_to_dict
 from automatic_models.models_tests.test_utils import preprocess_labels_soccernet, \
     get_bbox_from_two_points_model_notation, show_save_image_with_lines, \
     get_lines_from_test, convert_and_save_txt_to_csv, get_bbox_lists_from_csv
@@ -43,6 +44,10 @@ class ModelTester(VideoHandler):
             self.output_path = None
 
         self.save_images = save_images
+        self.registration_workers = 1
+        self.gate_frames = False
+        self.restrict_objects_to_field = False
+        self.object_tracker = None
         self.data_schema = data_schema
         self.model_configs = {}
         if models_config_path:
@@ -122,7 +127,7 @@ class ModelTester(VideoHandler):
             for index, objects in self.results['objects'].items():
                 self.results_transformed['players'][index] = []
                 self.results_transformed['balls'][index] = []
-                for one_object in objects.values():
+                for one_object in detections_to_dict(objects).values():
                     if one_object['class'] == 'PERSON':
                         self.results_transformed['players'][index]\
                             .append(get_bbox_from_two_points_model_notation(one_object))
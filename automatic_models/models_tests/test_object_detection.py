@@ -1,34 +1,68 @@
+import argparse
 from model_tester import ModelTester
 from pathlib import Path
 import pandas as pd
-if __name__ == '__main__':
-    i = 0
-    columns = ["iou_players", "iou_balls", "n_players_detected", "n_players_gt", "n_balls_gt", "n_balls_detected",
-               '% of balls detected', '% of players detected']
+
+# object detection modes compared in accuracy vs speed report, config is updated with given values
+MODES = {'pytorch fp32': {'backend': 'pytorch'},
+         'onnxruntime fp32': {'backend': 'onnxruntime'},
+         'onnxruntime int8 dynamic': {'backend': 'onnxruntime', 'quantization': 'dynamic'},
+         'onnxruntime int8 static': {'backend': 'onnxruntime', 'quantization': 'static'}}
+
+
+def evaluate_mode(mode_config: dict, columns: list):
     results_combined = dict()
-    for name in columns:
+    for name in columns + ['avg_inference_time']:
         results_combined[name] = []
     for folder in Path('./data/test_objects/data').iterdir():
-        try:
-            model_tester = ModelTester(match_folder=str(folder),
-                                       models_config_path='../data/configs/basic_config.json',
-                                       save_folder=str(folder),
-                                       save_images=False,
-                                       data_schema='objects_test')
-            model_tester.calc_object_stats()
-            for name in columns:
-                results_combined[name].append(model_tester.stats_objects[name])
-        except:
-            i += 1
-            print(f'{i} folders were not processed')
+        model_tester = ModelTester(match_folder=str(folder),
+                                   models_config_path='../data/configs/basic_config.json',
+                                   save_folder=str(folder),
+                                   save_images=False,
+                                   data_schema='objects_test')
+        model_tester.model_configs['object_detection_model'] = {
+            **model_tester.model_configs.get('object_detection_model', {}), **mode_config}
+        model_tester.calc_object_stats()
+        for name in columns:
+            results_combined[name].append(model_tester.stats_objects.get(name))
+        results_combined['avg_inference_time'].append(
+            model_tester.meta_data['object_detection_times']['avg_inference_time'])
 
     results_frame = pd.DataFrame()
     for name in results_combined.keys():
         results_frame[name] = results_combined[name]
+    return results_frame
+
 
-    combined = pd.DataFrame()
-    for col in ['iou_players', 'iou_balls', '% balls detected', '% players detected']:
-        combined[col] = pd.Series(results_frame[col].mean())
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-cp', '--calibration_path', type=str, default=None,
+                        help='image, video or folder with them, on which static quantization is calibrated '
+                             '(int8 static mode is skipped, if it is not provided)')
+    args = parser.parse_args()
+    if args.calibration_path:
+        MODES['onnxruntime int8 static']['calibration_path'] = args.calibration_path
+    else:
+        print('calibration_path was not provided, int8 static mode is skipped')
+        del MODES['onnxruntime int8 static']
 
+    columns = ["iou_players", "iou_balls", "n_players_detected", "n_players_gt", "n_balls_gt", "n_balls_detected",
+               '% of balls detected', '% of players detected']
+    results_frame = evaluate_mode(MODES['pytorch fp32'], columns)
     results_frame.to_csv('data/test_objects/results_combined.csv')
 
+    # accuracy vs speed report of quantized modes
+    report = []
+    for mode, mode_config in MODES.items():
+        mode_frame = results_frame if mode == 'pytorch fp32' else evaluate_mode(mode_config, columns)
+        report.append({'mode': mode,
+                       'iou_players': mode_frame['iou_players'].mean(),
+                       'iou_balls': mode_frame['iou_balls'].mean(),
+                       '% of players detected': mode_frame['% of players detected'].mean(),
+                       'avg_inference_time': mode_frame['avg_inference_time'].mean()})
+    report = pd.DataFrame(report)
+    report['speedup'] = report['avg_inference_time'].iloc[0] / report['avg_inference_time']
+    report['iou_players_drop'] = report['iou_players'].iloc[0] - report['iou_players']
+    report['players_recall_drop'] = report['% of players detected'].iloc[0] - report['% of players detected']
+    print(report)
+    report.to_csv('data/test_objects/quantization_report.csv')
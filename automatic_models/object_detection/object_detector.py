@@ -1,12 +1,20 @@
 """Script implements object detector, which detects players and ball from image."""
 
+import hashlib
+import time
+import cv2
 import numpy as np
 
 from dataclasses import dataclass
-from typing import Tuple, Dict, Optional, Any
-from detect import detect_2
+from pathlib import Path
+from typing import Tuple, Dict, Optional, Any, List, Iterator
+from detect import detect_2, detect_batch, load_model, letterbox_batch
 from labels import COCOLabels
 from automatic_models.extra_utils.constants import PATH_TO_AUTOMATIC_MODELS
+from automatic_models.extra_utils.helpers import generate_video_frames, points_in_polygon
+
+CALIBRATION_IMAGES = ['.jpg', '.jpeg', '.png']
+CALIBRATION_VIDEOS = ['.mp4', '.mkv', '.avi', '.webm']
 
 @dataclass
 class ObjectDetectorConfig:
@@ -18,6 +26,23 @@ class ObjectDetectorConfig:
     device: str = 'cpu'
     weights_location = f'{PATH_TO_AUTOMATIC_MODELS}/object_detection/yolo/yolov7.pt'  # critical point, if yolo breaks
     conf_threshold: float = 0.25
+    img_size: int = 640
+    fuse: bool = True
+    batch_size: int = 1
+    trace: bool = True
+    traced_dir: str = f'{PATH_TO_AUTOMATIC_MODELS}/object_detection/yolo/traced_models'
+    backend: str = 'pytorch'
+    onnx_threads: Optional[int] = None
+    quantization: Optional[str] = None
+    calibration_path: Optional[str] = None
+    calibration_frames: int = 32
+    detection_interval: int = 1
+    track_iou_threshold: float = 0.3
+    track_max_age: int = 1
+    track_confidence_decay: float = 0.9
+    redetect_confidence: float = 0.3
+    shot_change_threshold: float = 0.4
+    field_margin: float = 0.05
 
 
 class ObjectDetector:
@@ -29,11 +54,18 @@ class ObjectDetector:
     To use YOLO model for this task, I redesigned functions located in `yolo/detect.py` folder.
     In particular `detect_2.py` is implemented to use yolo inference to this project needs.
     Additionally private methods in this class serve to use YOLO for this task.
+    YOLO model is loaded only once per process (see `load_model` in `yolo/detect.py`), so creating ObjectDetector
+    for each frame does not deserialize checkpoint again. By default model is traced with TorchScript on first run
+    and traced artifact (keyed by weights hash, image size and device) is loaded directly by next processes.
+    On cpu, model can be run with onnxruntime instead of pytorch (backend: onnxruntime in config),
+    optionally INT8 quantized (quantization: dynamic/static in config).
+    If fields of frames are known (see `LineDetector.get_field`), detection can be restricted to pitch: frames are
+    cropped to bounding box of field (enlarged by field_margin) and only players standing on the field are kept.
 
     """
     def __init__(self,
-                 idx: int,
-                 image_array: np.ndarray,
+                 idx: Optional[int] = None,
+                 image_array: Optional[np.ndarray] = None,
                  model_config: Optional[Dict] = None,
                  image_path: Optional[np.ndarray] = None,
                  xywh_format: bool = False) -> None:
@@ -46,28 +78,170 @@ class ObjectDetector:
         if model_config:
             for key, value in model_config.items():
                 setattr(self.config, key, value)
+        assert self.config.backend in ['pytorch', 'onnxruntime']
+        assert self.config.quantization in [None, 'dynamic', 'static']
+        if self.config.quantization and self.config.backend != 'onnxruntime':
+            raise Exception('Quantization is supported only with onnxruntime backend.')
+        if self.config.quantization == 'static' and not self.config.calibration_path:
+            raise Exception('Static quantization requires calibration_path with frames or videos.')
         self.results = dict()
         self.output_image = None
+        self.timings = {'load_time': None, 'inference_time': None}
 
     def __call__(self) -> Tuple[Dict, Any, Dict]:
         """
         When called, YOLODetector is called with specific arguments.
         :return: (dictionary_with_detected_objects, image_with_mapped_objects, configuration dict)
         """
+        loaded_model = self._load_model()
+        start = time.time()
         txt, image = detect_2(source=self.image_path,
                               img_array=self.image_array,
-                              weights= self.config.weights_location,
-                              img_size=640,
+                              weights=self.config.weights_location,
+                              img_size=self.config.img_size,
                               conf_threshold=self.config.conf_threshold,
                               device=self.config.device,
                               save_txt=True,
                               nosave=True,
-                              xywh_format=self.xywh_format)
+                              xywh_format=self.xywh_format,
+                              loaded_model=loaded_model)
+        self.timings = {'load_time': loaded_model.load_time, 'inference_time': time.time() - start}
         self.results = self._map_raw_txt_to_dict(txt)
         self.output_image = image
 
         return self.results, self.output_image, self.config
 
+    def preprocess(self, image_arrays: List[np.ndarray]) -> np.ndarray:
+        """
+        Letterbox frames into one array, which can be passed to `detect_batch` (e.g when preprocessing is done
+        in other thread than inference).
+        """
+        loaded_model = self._load_model()
+        return letterbox_batch(image_arrays, loaded_model.img_size, loaded_model.stride)
+
+    def detect_batch(self,
+                     image_arrays: List[np.ndarray],
+                     letterboxed: Optional[np.ndarray] = None,
+                     fields: Optional[List[Optional[List]]] = None) -> List[np.ndarray]:
+        """
+        Detect objects on many frames at once. Frames are letterboxed into one tensor and go through YOLO in
+        a single forward pass. Only classes from config.objects_labels are kept (filtering is done inside NMS)
+        and nothing is drawn on frames. Inference time stored in timings is amortized per frame.
+        :param image_arrays: list of frames
+        :param letterboxed: frames preprocessed by `preprocess`, if None preprocessing is done here
+        :param fields: optional list with field polygon (list of [x, y] points) for each frame. If provided, frames are
+         cropped to bounding box of field before detection (letterboxed is ignored) and only persons, which bottom
+         center lies inside the field, are kept (ball in the air is drawn above the field, so balls found in
+         the crop are always kept). Frames with None field are processed whole.
+        :return: list with structured array of detections (see `DETECTIONS_DTYPE`) for each frame,
+        it can be converted to dictionary in self.results format with `detections_to_dict`
+        """
+        if fields is not None:
+            return self._detect_batch_on_fields(image_arrays, fields)
+        loaded_model = self._load_model()
+        start = time.time()
+        detections = detect_batch(img_arrays=image_arrays,
+                                  loaded_model=loaded_model,
+                                  conf_threshold=self.config.conf_threshold,
+                                  classes=[COCOLabels[label].value for label in self.config.objects_labels],
+                                  letterboxed=letterboxed)
+        self.timings = {'load_time': loaded_model.load_time,
+                        'inference_time': (time.time() - start) / len(image_arrays)}
+        return detections
+
+    def _detect_batch_on_fields(self,
+                                image_arrays: List[np.ndarray],
+                                fields: List[Optional[List]]) -> List[np.ndarray]:
+        """
+        Detect objects on frames cropped to bounding boxes of fields and keep only persons standing on the fields
+        (and all balls found in the crops). Boxes are returned in coordinates of whole frames.
+        """
+        crop_boxes = [self._get_field_crop_box(field, image_array.shape)
+                      for image_array, field in zip(image_arrays, fields)]
+        crops = [image_array[y_1: y_2, x_1: x_2]
+                 for image_array, (x_1, y_1, x_2, y_2) in zip(image_arrays, crop_boxes)]
+        detections_list = self.detect_batch(crops)
+        for i, (detections, (x_1, y_1, _, _), field) in enumerate(zip(detections_list, crop_boxes, fields)):
+            detections['x_top_left'] += x_1
+            detections['x_bottom_right'] += x_1
+            detections['y_top_left'] += y_1
+            detections['y_bottom_right'] += y_1
+            if field is not None and len(detections):
+                bottom_centers = np.stack([(detections['x_top_left'] + detections['x_bottom_right']) / 2,
+                                           detections['y_bottom_right']], axis=1)
+                keep = (detections['class_id'] != COCOLabels.PERSON.value) | \
+                    points_in_polygon(bottom_centers, np.array(field, dtype=float))
+                detections_list[i] = detections[keep]
+        return detections_list
+
+    def _get_field_crop_box(self, field: Optional[List], image_shape: Tuple) -> Tuple[int, int, int, int]:
+        """
+        Get bounding box of field enlarged by config.field_margin (relative to frame size) and clipped to frame,
+        in x_1, y_1, x_2, y_2 notation. Whole frame is returned if field is None or degenerated.
+        """
+        height, width = image_shape[:2]
+        if field is None:
+            return 0, 0, width, height
+        points = np.array(field, dtype=float)
+        margin_x, margin_y = self.config.field_margin * width, self.config.field_margin * height
+        x_1 = int(np.clip(np.floor(points[:, 0].min() - margin_x), 0, width))
+        y_1 = int(np.clip(np.floor(points[:, 1].min() - margin_y), 0, height))
+        x_2 = int(np.clip(np.ceil(points[:, 0].max() + margin_x), 0, width))
+        y_2 = int(np.clip(np.ceil(points[:, 1].max() + margin_y), 0, height))
+        if x_2 - x_1 < 2 or y_2 - y_1 < 2:
+            return 0, 0, width, height
+        return x_1, y_1, x_2, y_2
+
+    def _load_model(self):
+        """Load YOLO model (or get it from process-wide registry if it was already loaded)."""
+        return load_model(weights=self.config.weights_location,
+                          device=self.config.device,
+                          img_size=self.config.img_size,
+                          fuse=self.config.fuse,
+                          trace=self.config.trace,
+                          traced_dir=self.config.traced_dir,
+                          backend=self.config.backend,
+                          onnx_threads=self.config.onnx_threads,
+                          quantization=self.config.quantization,
+                          calibration_frames=self._calibration_frames,
+                          calibration_key=self._calibration_key() if self.config.quantization == 'static' else None)
+
+    def _calibration_files(self) -> List[Path]:
+        """Get images and videos from config.calibration_path (image, video or folder with them)."""
+        path = Path(self.config.calibration_path)
+        files = sorted(path.rglob('*')) if path.is_dir() else [path]
+        return [file for file in files if file.suffix.lower() in CALIBRATION_IMAGES + CALIBRATION_VIDEOS]
+
+    def _calibration_key(self) -> str:
+        """
+        Get fingerprint of calibration data (paths, sizes and modification times of calibration files and number of
+        calibration frames), so statically quantized model is calibrated again, when calibration data changes.
+        """
+        sha = hashlib.sha1(str(self.config.calibration_frames).encode())
+        for file in self._calibration_files():
+            stat = file.stat()
+            sha.update(f'{file.resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return sha.hexdigest()[:16]
+
+    def _calibration_frames(self) -> Iterator[np.ndarray]:
+        """
+        Yield at most config.calibration_frames frames from config.calibration_path (image, video or folder with them).
+        Videos are sampled every 10 seconds. Raises exception, if no frames are found.
+        """
+        n_frames = 0
+        for file in self._calibration_files():
+            if file.suffix.lower() in CALIBRATION_IMAGES:
+                frames = [cv2.imread(str(file))]
+            else:
+                frames = (frame for _, frame in generate_video_frames(str(file), desired_frequency=0.1))
+            for frame in frames:
+                yield frame
+                n_frames += 1
+                if n_frames == self.config.calibration_frames:
+                    return
+        if n_frames == 0:
+            raise Exception(f'No calibration frames (images or videos) found in {self.config.calibration_path}')
+
     def _map_raw_txt_to_dict(self,
                              txt_raw: list,
                              labels=COCOLabels
@@ -104,3 +278,14 @@ class ObjectDetector:
             return {}
 
 
+def detections_to_dict(detections: np.ndarray, labels=COCOLabels) -> Dict:
+    """
+    Map structured array of detections returned by `ObjectDetector.detect_batch` to dictionary
+    (the same format as ObjectDetector.results, boxes in x_top_left ... y_bottom_right notation).
+    :param detections: structured array of DETECTIONS_DTYPE (or TRACKS_DTYPE, then track_id is added to objects)
+    :param labels: labels for objects, by default COCOLabels are used
+    :return: dictionary with detected objects
+    """
+    fields = detections.dtype.names[1:]
+    return {i: {'class': labels(row[0]).name, **dict(zip(fields, row[1:]))}
+            for i, row in enumerate(detections.tolist())}
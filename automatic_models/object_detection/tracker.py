@@ -0,0 +1,192 @@
+"""Script implements lightweight multi-object tracker (SORT-style), which propagates detections between keyframes."""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from typing import List, Optional
+
+from detect import DETECTIONS_DTYPE
+from automatic_models.frame_gating.frame_gate import FrameGate
+
+# detections with identifier of track, to which they belong
+TRACKS_DTYPE = np.dtype(DETECTIONS_DTYPE.descr + [('track_id', np.int32)])
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Calculate intersection over union between every pair of boxes.
+    :param boxes_a: np.array with shape (N, 4), boxes in x_top_left, y_top_left, x_bottom_right, y_bottom_right notation
+    :param boxes_b: np.array with shape (M, 4)
+    :return: np.array with shape (N, M)
+    """
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+class KalmanBoxTrack:
+    """
+    Track of one object. Box is tracked with Kalman filter with constant velocity model,
+    state: (x_center, y_center, width, height) and their velocities (per sampled frame).
+    """
+    # state transition and measurement matrices
+    F = np.eye(8) + np.eye(8, k=4)
+    H = np.eye(4, 8)
+    # process and measurement noise covariances
+    Q = np.diag([1., 1., 1., 1., 1e-2, 1e-2, 1e-4, 1e-4])
+    R = np.diag([1., 1., 10., 10.])
+
+    def __init__(self, detection: np.void, track_id: int):
+        self.track_id = track_id
+        self.class_id = detection['class_id']
+        self.confidence = float(detection['confidence'])
+        self.state = np.zeros(8)
+        self.state[:4] = self._box_to_measurement(detection)
+        self.covariance = np.diag([10., 10., 10., 10., 1e4, 1e4, 1e4, 1e4])
+        self.frames_since_detection = 0
+        self.missed_keyframes = 0
+
+    def predict(self):
+        """Move track one frame forward."""
+        self.state = self.F @ self.state
+        self.state[2:4] = np.maximum(self.state[2:4], 1)
+        self.covariance = self.F @ self.covariance @ self.F.T + self.Q
+        self.frames_since_detection += 1
+
+    def update(self, detection: np.void):
+        """Correct track with matched detection."""
+        innovation = self._box_to_measurement(detection) - self.H @ self.state
+        innovation_covariance = self.H @ self.covariance @ self.H.T + self.R
+        gain = self.covariance @ self.H.T @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = (np.eye(8) - gain @ self.H) @ self.covariance
+        self.confidence = float(detection['confidence'])
+        self.frames_since_detection = 0
+
+    @property
+    def box(self) -> np.ndarray:
+        """Current box in x_top_left, y_top_left, x_bottom_right, y_bottom_right notation."""
+        center, size = self.state[:2], self.state[2:4]
+        return np.concatenate([center - size / 2, center + size / 2])
+
+    @staticmethod
+    def _box_to_measurement(detection: np.void) -> np.ndarray:
+        x_1, y_1, x_2, y_2 = (float(detection[name]) for name in DETECTIONS_DTYPE.names[1:5])
+        return np.array([(x_1 + x_2) / 2, (y_1 + y_2) / 2, x_2 - x_1, y_2 - y_1])
+
+
+class ObjectTracker:
+    """
+    ObjectTracker is responsible for propagating detections between keyframes, on which detector is run.
+    Frames are passed in time order to `step`, which predicts tracks and decides if frame is a keyframe:
+    every detection_interval frame, on shot change (see `FrameGate`) and when mean confidence of tracks drops
+    below redetect_confidence (confidence of predicted box decays with every frame without detection).
+    On keyframes detections are matched with predicted tracks (Hungarian matching on IoU, objects of the same class
+    only) in `update`, matched tracks are corrected with detections, unmatched detections start new tracks and
+    tracks unmatched on more than max_age keyframes are removed. On other frames predicted tracks matched on last
+    keyframe are used (see `get_tracks`), unmatched tracks are kept only to be matched on next keyframes.
+
+    Parameters for initialization:
+    :param detection_interval: maximal number of frames between keyframes
+    :param iou_threshold: minimal IoU between detection and predicted track to match them
+    :param max_age: number of keyframes, on which track might be unmatched before it is removed
+    :param confidence_decay: confidence of predicted box is multiplied by this value for every frame without detection
+    :param redetect_confidence: if mean confidence of tracks is lower, detector is run on frame
+    :param shot_change_threshold: histogram distance between consecutive frames, above which tracks are removed and
+     detector is run on frame
+    """
+    def __init__(self,
+                 detection_interval: int,
+                 iou_threshold: float = 0.3,
+                 max_age: int = 1,
+                 confidence_decay: float = 0.9,
+                 redetect_confidence: float = 0.3,
+                 shot_change_threshold: float = 0.4):
+        assert detection_interval > 0
+        self.detection_interval = detection_interval
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.confidence_decay = confidence_decay
+        self.redetect_confidence = redetect_confidence
+        self.frame_gate = FrameGate(model_config={'shot_boundary_threshold': shot_change_threshold})
+        self.tracks: List[KalmanBoxTrack] = []
+        self.next_track_id = 0
+        self.frames_since_keyframe: Optional[int] = None
+
+    def step(self, image_array: np.ndarray) -> Optional[str]:
+        """
+        Move all tracks to next frame and check, if detector should be run on it.
+        :param image_array: frame in BGR format
+        :return: reason, why detector should be run on frame (interval/shot_change/low_confidence) or None
+        """
+        for track in self.tracks:
+            track.predict()
+        shot_change = self.frame_gate(image_array)['shot_boundary']
+        if shot_change:
+            self.reset()
+        if self.frames_since_keyframe is None or self.frames_since_keyframe + 1 >= self.detection_interval:
+            reason = 'interval'
+        elif shot_change:
+            reason = 'shot_change'
+        elif self.tracks and self.get_confidences(self.tracks).mean() < self.redetect_confidence:
+            reason = 'low_confidence'
+        else:
+            reason = None
+        self.frames_since_keyframe = 0 if reason else self.frames_since_keyframe + 1
+        return reason
+
+    def update(self, detections: np.ndarray) -> np.ndarray:
+        """
+        Correct tracks (already predicted for current frame) with detections from keyframe.
+        :param detections: structured array of DETECTIONS_DTYPE
+        :return: structured array of TRACKS_DTYPE, detections with identifiers of tracks (in order of detections)
+        """
+        boxes = np.stack([detections[name] for name in DETECTIONS_DTYPE.names[1:5]], axis=1).astype(float) \
+            if len(detections) else np.empty((0, 4))
+        matched_tracks = {}
+        if self.tracks and len(detections):
+            iou = iou_matrix(boxes, np.stack([track.box for track in self.tracks]))
+            iou[detections['class_id'][:, None] != np.array([track.class_id for track in self.tracks])[None]] = 0
+            for detection_idx, track_idx in zip(*linear_sum_assignment(-iou)):
+                if iou[detection_idx, track_idx] >= self.iou_threshold:
+                    matched_tracks[detection_idx] = self.tracks[track_idx]
+
+        for track in self.tracks:
+            track.missed_keyframes = 0 if track in matched_tracks.values() else track.missed_keyframes + 1
+        self.tracks = [track for track in self.tracks if track.missed_keyframes <= self.max_age]
+
+        tracked = np.empty(len(detections), dtype=TRACKS_DTYPE)
+        for detection_idx, detection in enumerate(detections):
+            track = matched_tracks.get(detection_idx)
+            if track is not None:
+                track.update(detection)
+            else:
+                track = KalmanBoxTrack(detection, track_id=self.next_track_id)
+                self.next_track_id += 1
+                self.tracks.append(track)
+            tracked[detection_idx] = tuple(detection) + (track.track_id,)
+        return tracked
+
+    def get_tracks(self) -> np.ndarray:
+        """
+        Get current boxes of tracks matched on last keyframe, confidence decays with number of frames since last
+        detection.
+        :return: structured array of TRACKS_DTYPE
+        """
+        tracks = [track for track in self.tracks if track.missed_keyframes == 0]
+        tracked = np.empty(len(tracks), dtype=TRACKS_DTYPE)
+        for i, (track, confidence) in enumerate(zip(tracks, self.get_confidences(tracks))):
+            tracked[i] = (track.class_id, *track.box, confidence, track.track_id)
+        return tracked
+
+    def get_confidences(self, tracks: List[KalmanBoxTrack]) -> np.ndarray:
+        """Get confidence of every track, decayed with number of frames since last detection."""
+        return np.array([track.confidence * self.confidence_decay ** track.frames_since_detection
+                         for track in tracks])
+
+    def reset(self):
+        """Remove all tracks (e.g on shot change), identifiers of next tracks are not reused."""
+        self.tracks = []
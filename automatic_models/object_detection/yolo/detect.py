@@ -1,6 +1,10 @@
 import argparse
+import hashlib
+import threading
 import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
 import cv2
@@ -13,7 +17,183 @@ from utils.datasets import LoadStreams, LoadImages, letterbox
 from utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
     scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
 from utils.plots import plot_one_box
-from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
+from utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel, OnnxRuntimeModel
+
+
+@dataclass
+class LoadedModel:
+    """
+    YOLO model loaded into memory together with everything `detect_2` needs to run it.
+    """
+    model: torch.nn.Module
+    device: torch.device
+    half: bool
+    stride: int
+    img_size: int
+    names: List[str]
+    colors: List[List[int]]
+    load_time: float
+
+
+# one row per detected object, boxes are given in pixels of original frame
+DETECTIONS_DTYPE = np.dtype([('class_id', np.int16),
+                             ('x_top_left', np.float32),
+                             ('y_top_left', np.float32),
+                             ('x_bottom_right', np.float32),
+                             ('y_bottom_right', np.float32),
+                             ('confidence', np.float32)])
+
+# process-wide registry of loaded models, keyed by (weights, device, img_size, fuse, trace, backend, onnx_threads)
+_MODEL_REGISTRY: Dict[Tuple, LoadedModel] = {}
+_MODEL_REGISTRY_LOCK = threading.RLock()  # model might be requested from many threads (e.g pipeline stages)
+
+
+def weights_hash(weights) -> str:
+    """
+    Calculate sha1 hash of weights file(s), used as a key of traced model artifacts.
+    :param weights: path (or list of paths for ensemble) to model weights
+    """
+    sha1 = hashlib.sha1()
+    for w in (weights if isinstance(weights, list) else [weights]):
+        with open(w, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def model_artifact_path(weights, img_size: int, device: torch.device, artifacts_dir: str,
+                        suffix: str = '.torchscript.pt') -> Path:
+    """
+    Get location of traced/exported model artifact, artifact is keyed by weights hash, image size and device.
+    """
+    device_name = str(device).replace(':', '_')
+    return Path(artifacts_dir) / f'{weights_hash(weights)[:16]}_{img_size}_{device_name}{suffix}'
+
+
+def load_model(weights='yolov7.pt',
+               device: str = 'cpu',
+               img_size: int = 640,
+               fuse: bool = True,
+               trace: bool = False,
+               traced_dir: str = 'traced_models',
+               backend: str = 'pytorch',
+               onnx_threads: Optional[int] = None,
+               quantization: Optional[str] = None,
+               calibration_frames: Optional[Callable[[], Iterable[np.ndarray]]] = None,
+               calibration_key: Optional[str] = None) -> LoadedModel:
+    """
+    Load YOLO model only once per process. Model is kept in registry, so consecutive calls with the same weights,
+    device and image size return already loaded model instead of deserializing checkpoint again.
+    If trace is True, model is fused, traced with TorchScript and saved in traced_dir on first run. Later runs
+    (i.e. next processes) load traced artifact directly, without building model from checkpoint.
+    If backend is 'onnxruntime', model backbone is exported to ONNX on first run (and cached in traced_dir in the same
+    way as traced model), and run by onnxruntime session on cpu. Exported model can be INT8 quantized
+    (dynamic or static quantization, static quantization is calibrated on frames given by calibration_frames).
+    :param weights: path (or list of paths for ensemble) to model weights
+    :param device: 'cpu' or cuda device, i.e. '0' or '0,1,2,3'
+    :param img_size: inference size in pixels
+    :param fuse: if True Conv2d and BatchNorm2d layers are fused at load time
+    :param trace: if True TorchScript traced model is used (ensembles are not traced)
+    :param traced_dir: folder with traced/exported model artifacts
+    :param backend: pytorch/onnxruntime
+    :param onnx_threads: number of intra-op threads of onnxruntime session, if None all physical cores are used
+    :param quantization: None/dynamic/static, INT8 quantization of model (only with onnxruntime backend)
+    :param calibration_frames: function returning frames (BGR), on which static quantization is calibrated
+    :param calibration_key: fingerprint of calibration frames, statically quantized model is cached per fingerprint
+    :return: LoadedModel with model and its inference parameters
+    """
+    weights_key = tuple(str(Path(w).resolve()) for w in (weights if isinstance(weights, list) else [weights]))
+    key = (weights_key, device, img_size, fuse, trace, backend, onnx_threads, quantization, calibration_key)
+    with _MODEL_REGISTRY_LOCK:
+        if key not in _MODEL_REGISTRY:
+            _MODEL_REGISTRY[key] = _load_model(weights, device, img_size, fuse, trace, traced_dir, backend,
+                                               onnx_threads, quantization, calibration_frames, calibration_key)
+    return _MODEL_REGISTRY[key]
+
+
+def _load_model(weights, device, img_size, fuse, trace, traced_dir, backend, onnx_threads, quantization,
+                calibration_frames, calibration_key) -> LoadedModel:
+    """Load model as described in `load_model` (without registry)."""
+    weights_key = tuple(str(Path(w).resolve()) for w in (weights if isinstance(weights, list) else [weights]))
+    t0 = time.time()
+    set_logging()
+    torch_device = select_device(device)
+    half = torch_device.type != 'cpu'  # half precision only supported on CUDA
+
+    if backend == 'onnxruntime':
+        if torch_device.type != 'cpu' or len(weights_key) > 1:
+            raise Exception('onnxruntime backend supports only cpu device and single weights file')
+        onnx_path = model_artifact_path(weights, img_size, torch_device, traced_dir, suffix='.onnx')
+        # statically quantized model depends on calibration data, so it is cached per calibration fingerprint
+        quantization_name = f'{quantization}_{calibration_key}' if quantization == 'static' and calibration_key \
+            else quantization
+        quantized_path = model_artifact_path(weights, img_size, torch_device, traced_dir,
+                                             suffix=f'.int8_{quantization_name}.onnx') if quantization else None
+
+        def build_artifacts(rebuild: bool = False):
+            # artifacts are written atomically, so files of other processes are either complete or absent
+            if rebuild or not OnnxRuntimeModel.exists(str(onnx_path)):
+                fp32_model = attempt_load(weights, map_location=torch_device, fuse=True)  # load FP32 model
+                onnx_path.parent.mkdir(parents=True, exist_ok=True)
+                OnnxRuntimeModel.export(fp32_model, check_img_size(img_size, s=int(fp32_model.stride.max())),
+                                        str(onnx_path))
+            if quantized_path and (rebuild or not quantized_path.exists()):
+                calibration_images = None
+                if quantization == 'static':
+                    stride = int(torch.load(str(onnx_path) + '.detect', map_location='cpu')['stride'].max())
+                    imgsz = check_img_size(img_size, s=stride)
+                    calibration_images = (letterbox_batch([frame], imgsz, stride).astype(np.float32) / 255.0
+                                          for frame in calibration_frames())
+                OnnxRuntimeModel.quantize(str(onnx_path), str(quantized_path), quantization, calibration_images)
+
+        build_artifacts()
+        try:
+            model = OnnxRuntimeModel(str(quantized_path or onnx_path), threads=onnx_threads,
+                                     detect_path=str(onnx_path) + '.detect')
+        except Exception as e:
+            print(f'Cached ONNX model could not be loaded ({e}), exporting it again.')
+            build_artifacts(rebuild=True)
+            model = OnnxRuntimeModel(str(quantized_path or onnx_path), threads=onnx_threads,
+                                     detect_path=str(onnx_path) + '.detect')
+        stride = int(model.stride.max())  # model stride
+        imgsz = check_img_size(img_size, s=stride)  # check img_size
+        names = model.names
+        colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
+        return LoadedModel(model=model, device=torch_device, half=False, stride=stride, img_size=imgsz,
+                           names=names, colors=colors, load_time=time.time() - t0)
+
+    traced_path = model_artifact_path(weights, img_size, torch_device, traced_dir) \
+        if trace and len(weights_key) == 1 else None
+    model = None
+    if traced_path and TracedModel.exists(str(traced_path)):
+        try:
+            model = TracedModel.load(str(traced_path), device=torch_device)
+            stride = int(model.stride.max())  # model stride
+            imgsz = check_img_size(img_size, s=stride)  # check img_size
+        except Exception as e:
+            print(f'Traced model {traced_path} could not be loaded ({e}), tracing it again.')
+            model = None
+    if model is None:
+        model = attempt_load(weights, map_location=torch_device, fuse=fuse or trace)  # load FP32 model
+        stride = int(model.stride.max())  # model stride
+        imgsz = check_img_size(img_size, s=stride)  # check img_size
+        if traced_path:
+            traced_path.parent.mkdir(parents=True, exist_ok=True)
+            model = TracedModel(model, torch_device, imgsz, save_path=str(traced_path))
+    if half:
+        model.half()  # to FP16
+
+    # Get names and colors
+    names = model.module.names if hasattr(model, 'module') else model.names
+    colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
+
+    # Warmup
+    if torch_device.type != 'cpu':
+        for _ in range(3):
+            model(torch.zeros(1, 3, imgsz, imgsz).to(torch_device).type_as(next(model.parameters())))
+
+    return LoadedModel(model=model, device=torch_device, half=half, stride=stride, img_size=imgsz,
+                       names=names, colors=colors, load_time=time.time() - t0)
 
 
 def detect(file_image: str, save_img=False):
@@ -181,22 +361,18 @@ def detect_2(img_array: np.ndarray,
              update=False,
              name='img',
              exist_ok=False,
-             xywh_format=False):
+             xywh_format=False,
+             fuse=True,
+             loaded_model: Optional[LoadedModel] = None):
     source, weights, view_img, save_txt, imgsz = source, weights, view_img, save_txt, img_size
     save_img = not nosave and not source.endswith('.txt')  # save inference images
 
-    # Initialize
-    set_logging()
-    device = select_device(device)
-    half = device.type != 'cpu'  # half precision only supported on CUDA
-
-    # Load model
-    model = attempt_load(weights, map_location=device)  # load FP32 model
-    stride = int(model.stride.max())  # model stride
-    imgsz = check_img_size(imgsz, s=stride)  # check img_size
-
-    if half:
-        model.half()  # to FP16
+    # Load model (only first call in a process deserializes checkpoint)
+    if loaded_model is None:
+        loaded_model = load_model(weights, device=device, img_size=img_size, fuse=fuse)
+    model, device, half = loaded_model.model, loaded_model.device, loaded_model.half
+    stride, imgsz = loaded_model.stride, loaded_model.img_size
+    names, colors = loaded_model.names, loaded_model.colors
 
     # Second-stage classifier
     classify = False
@@ -211,31 +387,12 @@ def detect_2(img_array: np.ndarray,
     img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
     img = np.ascontiguousarray(img)
 
-    # Get names and colors
-    names = model.module.names if hasattr(model, 'module') else model.names
-    colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
-
-    # Run inference
-    if device.type != 'cpu':
-        model(torch.zeros(1, 3, imgsz, imgsz).to(device).type_as(next(model.parameters())))  # run once
-    old_img_w = old_img_h = imgsz
-    old_img_b = 1
-
-    t0 = time.time()
     img = torch.from_numpy(img).to(device)
     img = img.half() if half else img.float()  # uint8 to fp16/32
     img /= 255.0  # 0 - 255 to 0.0 - 1.0
     if img.ndimension() == 3:
         img = img.unsqueeze(0)
 
-    # Warmup
-    if device.type != 'cpu' and (old_img_b != img.shape[0] or old_img_h != img.shape[2] or old_img_w != img.shape[3]):
-        old_img_b = img.shape[0]
-        old_img_h = img.shape[2]
-        old_img_w = img.shape[3]
-        for i in range(3):
-            model(img, augment=augment)[0]
-
     # Inference
     t1 = time_synchronized()
     with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
@@ -284,6 +441,68 @@ def detect_2(img_array: np.ndarray,
 
 
 
+def letterbox_batch(img_arrays: List[np.ndarray], img_size: int, stride: int) -> np.ndarray:
+    """
+    Letterbox frames (BGR, as loaded by opencv) and stack them into one uint8 array of shape Bx3xHxW (RGB).
+    """
+    # frames of the same video share shape, so minimum rectangle letterbox gives the same tensor shape for all
+    # of them; otherwise frames are letterboxed to square shape
+    same_shape = all(img_array.shape == img_arrays[0].shape for img_array in img_arrays)
+    img = np.stack([letterbox(img_array, img_size, stride=stride, auto=same_shape)[0] for img_array in img_arrays])
+    img = img[..., ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to Bx3x416x416
+    return np.ascontiguousarray(img)
+
+
+def detect_batch(img_arrays: List[np.ndarray],
+                 loaded_model: LoadedModel,
+                 conf_threshold: float = 0.25,
+                 iou_thres=0.45,
+                 classes=None,
+                 agnostic_nms=False,
+                 augment=False,
+                 letterboxed: Optional[np.ndarray] = None) -> List[np.ndarray]:
+    """
+    Lean, batched version of `detect_2` used for production inference. Frames are letterboxed into one tensor,
+    which goes through model in a single forward pass, followed by one non_max_suppression call for the whole batch.
+    Nothing is drawn on frames and no text is formatted, detections are returned as numpy structured arrays.
+    :param img_arrays: list of images (BGR, as loaded by opencv)
+    :param loaded_model: model returned by `load_model`
+    :param classes: list of class ids kept by non_max_suppression, if None all classes are kept
+    :param letterboxed: frames already preprocessed by `letterbox_batch` (e.g in other thread), if None frames
+    are letterboxed here
+    :return: list with structured array of DETECTIONS_DTYPE (boxes in pixels of original frame) for each frame
+    """
+    model, device, half = loaded_model.model, loaded_model.device, loaded_model.half
+    stride, imgsz = loaded_model.stride, loaded_model.img_size
+
+    if letterboxed is None:
+        letterboxed = letterbox_batch(img_arrays, imgsz, stride)
+    img = torch.from_numpy(letterboxed).to(device)
+    img = img.half() if half else img.float()  # uint8 to fp16/32
+    img /= 255.0  # 0 - 255 to 0.0 - 1.0
+
+    # Inference
+    with torch.no_grad():   # Calculating gradients would cause a GPU memory leak
+        pred = model(img, augment=augment)[0]
+
+    # Apply NMS
+    pred = non_max_suppression(pred, conf_threshold, iou_thres, classes=classes, agnostic=agnostic_nms)
+
+    # Process detections
+    results = []
+    for det, im0 in zip(pred, img_arrays):  # detections per image
+        detections = np.empty(len(det), dtype=DETECTIONS_DTYPE)
+        if len(det):
+            # Rescale boxes from img_size to im0 size
+            det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+            det = det.flip(0).float().cpu().numpy()  # same order as in `detect_2`
+            detections['class_id'] = det[:, 5]
+            for i, field in enumerate(['x_top_left', 'y_top_left', 'x_bottom_right', 'y_bottom_right', 'confidence']):
+                detections[field] = det[:, i]
+        results.append(detections)
+    return results
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', nargs='+', type=str, default='yolov7.pt', help='model.pt path(s)')
@@ -244,13 +244,14 @@ class End2End(nn.Module):
 
 
 
-def attempt_load(weights, map_location=None):
+def attempt_load(weights, map_location=None, fuse=True):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
         attempt_download(w)
         ckpt = torch.load(w, map_location=map_location)  # load
-        model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
+        ckpt_model = ckpt['ema' if ckpt.get('ema') else 'model'].float()
+        model.append((ckpt_model.fuse() if fuse else ckpt_model).eval())  # FP32 model
     
     # Compatibility updates
     for m in model.modules():
@@ -5,8 +5,10 @@ import logging
 import math
 import os
 import platform
+import shutil
 import subprocess
 import time
+import uuid
 from contextlib import contextmanager
 from copy import deepcopy
 from pathlib import Path
@@ -340,9 +342,21 @@ def revert_sync_batchnorm(module):
     return module_output
 
 
+def atomic_save(save_function, path):
+    # call save_function with unique temporary path next to path and atomically move result to path, so concurrent
+    # processes never see partially written file (suffix is kept, since some writers depend on it)
+    tmp_path = f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp{Path(path).suffix}'
+    try:
+        save_function(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 class TracedModel(nn.Module):
 
-    def __init__(self, model=None, device=None, img_size=(640,640)): 
+    def __init__(self, model=None, device=None, img_size=(640,640), save_path="traced_model.pt"): 
         super(TracedModel, self).__init__()
         
         print(" Convert model to Traced-model... ") 
@@ -361,14 +375,125 @@ class TracedModel(nn.Module):
         
         traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
         #traced_script_module = torch.jit.script(self.model)
-        traced_script_module.save("traced_model.pt")
+        # Detect layer is not traced, it is saved next to traced module, so model can be restored with `load`.
+        # Both files are written atomically and traced module is written last, so its presence means
+        # artifact is complete (see `exists`)
+        atomic_save(lambda path: torch.save({'detect_layer': self.detect_layer, 'stride': self.stride,
+                                             'names': self.names}, path), save_path + '.detect')
+        atomic_save(traced_script_module.save, save_path)
         print(" traced_script_module saved! ")
         self.model = traced_script_module
         self.model.to(device)
         self.detect_layer.to(device)
         print(" model is traced! \n") 
 
+    @staticmethod
+    def exists(path):
+        # artifact saved by __init__ is complete only if both traced module and Detect layer exist
+        return os.path.exists(path) and os.path.exists(path + '.detect')
+
+    @classmethod
+    def load(cls, path, device=None):
+        # restore traced model saved by __init__ without loading original weights and tracing again
+        traced = cls.__new__(cls)
+        nn.Module.__init__(traced)
+        extra = torch.load(path + '.detect', map_location=device)
+        traced.stride, traced.names = extra['stride'], extra['names']
+        traced.model = torch.jit.load(path, map_location=device)
+        traced.detect_layer = extra['detect_layer'].to(device)
+        return traced
+
     def forward(self, x, augment=False, profile=False):
         out = self.model(x)
         out = self.detect_layer(out)
-        return out
\ No newline at end of file
+        return out
+
+
+class OnnxRuntimeModel(nn.Module):
+    # Backbone is exported to ONNX and run by onnxruntime session, Detect layer is run by pytorch (as in TracedModel),
+    # so grid is built for any input shape and outputs are the same as outputs of pytorch model
+
+    def __init__(self, path, threads=None, detect_path=None):
+        super(OnnxRuntimeModel, self).__init__()
+        extra = torch.load(detect_path or path + '.detect', map_location='cpu')
+        self.stride, self.names = extra['stride'], extra['names']
+        self.detect_layer = extra['detect_layer']
+        self.session = self.create_session(path, threads)
+
+    @staticmethod
+    def exists(path):
+        # artifact saved by export is complete only if both ONNX model and Detect layer exist
+        return os.path.exists(path) and os.path.exists(path + '.detect')
+
+    @staticmethod
+    def export(model, img_size=640, save_path="model.onnx"):
+        # export backbone of model to ONNX, Detect layer is saved next to it
+        print(" Export model to ONNX... ")
+        model = revert_sync_batchnorm(model)
+        model.to('cpu')
+        model.eval()
+
+        detect_layer = model.model[-1]
+        model.traced = True
+
+        output_names = [f'features_{i}' for i in range(len(detect_layer.f))]
+        dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ['images'] + output_names}
+        # both files are written atomically and ONNX model is written last (as in TracedModel)
+        atomic_save(lambda path: torch.save({'detect_layer': detect_layer, 'stride': model.stride,
+                                             'names': model.names}, path), save_path + '.detect')
+        atomic_save(lambda path: torch.onnx.export(model, torch.rand(1, 3, img_size, img_size), path,
+                                                   opset_version=13, input_names=['images'],
+                                                   output_names=output_names, dynamic_axes=dynamic_axes),
+                    save_path)
+        print(" ONNX model saved! ")
+
+    @staticmethod
+    def quantize(path, save_path, mode='dynamic', calibration_images=None):
+        # INT8 post-training quantization of exported model, static quantization is calibrated on
+        # calibration_images (iterable of preprocessed float32 arrays of shape (1, 3, h, w))
+        from onnxruntime.quantization import quantize_dynamic, quantize_static, CalibrationDataReader, \
+            QuantFormat, QuantType
+
+        class ImagesReader(CalibrationDataReader):
+            def __init__(self, images):
+                self.images = iter(images)
+
+            def get_next(self):
+                image = next(self.images, None)
+                return None if image is None else {'images': image}
+
+        if mode not in ['dynamic', 'static']:
+            raise Exception(f'Unknown quantization mode {mode}')
+        print(f" Quantize ONNX model ({mode})... ")
+        # quantization writes intermediate files next to its input, so each process quantizes its own copy
+        input_path = f'{save_path}.{os.getpid()}.{uuid.uuid4().hex}.input.onnx'
+        shutil.copyfile(path, input_path)
+        try:
+            if mode == 'dynamic':
+                atomic_save(lambda tmp_path: quantize_dynamic(input_path, tmp_path, weight_type=QuantType.QUInt8),
+                            save_path)
+            else:
+                atomic_save(lambda tmp_path: quantize_static(input_path, tmp_path, ImagesReader(calibration_images),
+                                                             quant_format=QuantFormat.QDQ, per_channel=True,
+                                                             activation_type=QuantType.QUInt8,
+                                                             weight_type=QuantType.QInt8), save_path)
+        finally:
+            os.remove(input_path)
+        print(" Quantized ONNX model saved! ")
+
+    @staticmethod
+    def create_session(path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL  # graph is a chain of convs, parallelism is intra-op
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads  # by default onnxruntime uses all physical cores
+        return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def forward(self, x, augment=False, profile=False):
+        out = self.session.run(None, {'images': x.cpu().numpy()})
+        out = self.detect_layer([torch.from_numpy(o) for o in out])
+        return out